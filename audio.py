@@ -0,0 +1,55 @@
+import logging
+from array import array
+
+
+class NullAudio:
+    # Silence, for headless runs and machines without a sound device
+
+    def update(self, sounding):
+        pass
+
+    def close(self):
+        pass
+
+
+class SquareWave:
+    # A square wave synthesized once and looped while the sound timer is
+    # non-zero. A short mixer buffer keeps the delay from update() to the
+    # tone starting or stopping down to a few milliseconds.
+
+    def __init__(self, frequency=440, volume=0.2, rate=44100, buffer=256):
+        import pygame
+        pygame.mixer.init(frequency=rate, size=-16, channels=1, buffer=buffer)
+        rate, size, channels = pygame.mixer.get_init()
+        # whole periods, so the loop joins up without a click
+        period = max(round(rate / frequency), 2)
+        periods = max(rate // 10 // period, 1)
+        amplitude = int(volume * 32767)
+        wave = array('h', [amplitude] * (period // 2) + [-amplitude] * (period - period // 2))
+        samples = array('h')
+        for sample in wave * periods:
+            samples.extend([sample] * channels)
+        self.sound = pygame.mixer.Sound(buffer=samples)
+        self.playing = False
+
+    def update(self, sounding):
+        # Start or stop the tone, sounding is whether the sound timer runs
+        if sounding != self.playing:
+            if sounding:
+                self.sound.play(loops=-1)
+            else:
+                self.sound.stop()
+            self.playing = sounding
+
+    def close(self):
+        self.sound.stop()
+
+
+def open_audio(enabled=True):
+    # A square wave when a sound device is available, silence otherwise
+    if enabled:
+        try:
+            return SquareWave()
+        except Exception as e:
+            logging.warning("No sound: %s", e)
+    return NullAudio()
@@ -0,0 +1,86 @@
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cpu import CPU
+from replay import drive
+from translator import Translator
+
+# One run: ROM path, instruction budget, input script and random seed.
+# The script is either None or (name, events) with events a sequence of
+# (frame, key, pressed).
+Job = namedtuple('Job', 'rom cycles script seed', defaults=(0,))
+
+Result = namedtuple('Result', 'rom cycles script executed frames hash framebuffer trap elapsed error')
+
+
+def load_script(path):
+    # Text input script, one "frame key pressed" event per line, key in hex
+    events = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if fields:
+                events.append((int(fields[0]), int(fields[1], 16), int(fields[2])))
+    return tuple(events)
+
+
+def state_hash(cpu):
+    h = hashlib.sha1()
+    h.update(cpu.memory)
+    h.update(cpu.register)
+    h.update(bytes([cpu.I >> 8, cpu.I & 0xff, cpu.pc >> 8, cpu.pc & 0xff, cpu.delayTimer, cpu.soundTimer]))
+    h.update(",".join("%X" % x for x in cpu.stack).encode())
+    h.update(cpu.frameBuffer.tobytes())
+    return h.hexdigest()
+
+
+def run_job(job):
+    rom, cycles, script, seed = job
+    start = time.perf_counter()
+    cpu = CPU(seed)
+    translator = Translator(cpu)
+    translator.load(rom)
+    executed = drive(cpu, script[1] if script else (), cycles, translator)
+    return Result(rom, cycles, script[0] if script else None, executed, cpu.frames, state_hash(cpu),
+                  cpu.frameBuffer.tobytes(), cpu.trap, time.perf_counter() - start, None)
+
+
+def run_batch(jobs, workers=None):
+    # Run jobs across a process pool, yielding results as they finish
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                rom, cycles, script, seed = futures[future]
+                yield Result(rom, cycles, script[0] if script else None, 0, 0, None, None, None, 0, repr(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many chip-8 ROMs headless in parallel")
+    parser.add_argument('roms', nargs='+')
+    parser.add_argument('--cycles', type=int, nargs='+', default=[100000], help="instruction budgets to run each ROM for")
+    parser.add_argument('--inputs', nargs='*', default=[], help="input scripts, each ROM also runs without input")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0, help="random seed every run starts from")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    scripts = [None] + [(path, load_script(path)) for path in args.inputs]
+    jobs = [Job(*job, args.seed) for job in itertools.product(args.roms, args.cycles, scripts)]
+    for result in run_batch(jobs, args.workers):
+        record = result._asdict()
+        record['framebuffer'] = result.framebuffer.hex() if result.framebuffer else None
+        print(json.dumps(record), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+from cpu import CPU
+from translator import Translator
+
+
+def sample(pattern):
+    # An opcode that decodes to pattern, with x = 1, y = 2 and n = 3
+    if pattern in (0x00e0, 0x00ee):
+        return pattern
+    if pattern & 0xf000 == 0x8000:
+        return (pattern & 0xf00f) | 0x0120
+    if pattern & 0xf000 in (0xe000, 0xf000):
+        return pattern | 0x0100
+    return pattern | 0x0123
+
+
+def best(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_handler(pattern, calls, repeat):
+    cpu = CPU()
+    op = sample(pattern)
+    handler, operands = CPU.table[op]
+    assert CPU.pattern(op) == pattern
+
+    def loop():
+        cpu.reset()
+        cpu.I = 0x300
+        cpu.stack.extend([0x200] * calls)
+        for _ in range(calls):
+            handler(cpu, *operands)
+    return calls / best(loop, repeat)
+
+
+def bench_rom(rom, cycles, repeat, translate=False):
+    # seeded, so every run draws the same random numbers
+    cpu = CPU(0)
+    # count only instructions that really run, idle frames are not skipped
+    cpu.skipIdle = False
+    # flushed by every reset, so each run translates its blocks again
+    translator = Translator(cpu)
+    result = {}
+
+    def run():
+        cpu.reset()
+        cpu.load_rom(rom)
+        if translate:
+            result['executed'] = translator.run(cycles)
+        else:
+            result['executed'] = cpu.run(cycles)
+        result['frames'] = cpu.frames
+    elapsed = best(run, repeat)
+    return {
+        'ips': result['executed'] / elapsed,
+        'fps': result['frames'] / elapsed,
+    }
+
+
+def run_suite(roms, calls, cycles, repeat):
+    results = {
+        'python': platform.python_version(),
+        'handlers': {},
+        'roms': {},
+    }
+    for pattern, (name, _) in CPU.opcodes.items():
+        results['handlers'][name] = bench_handler(pattern, calls, repeat)
+    for rom in roms:
+        name = os.path.splitext(os.path.basename(rom))[0]
+        results['roms'][name] = bench_rom(rom, cycles, repeat)
+        results['roms'][name + '+translate'] = bench_rom(rom, cycles, repeat, translate=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Metrics that fell more than threshold (a fraction) below the baseline
+    regressions = []
+    for name, value in results['handlers'].items():
+        old = baseline.get('handlers', {}).get(name)
+        if old and value < old * (1 - threshold):
+            regressions.append(("handler %s" % name, old, value))
+    for name, metrics in results['roms'].items():
+        for metric, value in metrics.items():
+            old = baseline.get('roms', {}).get(name, {}).get(metric)
+            if old and value < old * (1 - threshold):
+                regressions.append(("rom %s %s" % (name, metric), old, value))
+    return regressions
+
+
+def report(results):
+    lines = ["%-12s %14s" % ("handler", "calls/s")]
+    for name, value in results['handlers'].items():
+        lines.append("%-12s %14.0f" % (name, value))
+    lines.append("")
+    lines.append("%-20s %14s %10s" % ("rom", "instr/s", "frames/s"))
+    for name, metrics in results['roms'].items():
+        lines.append("%-20s %14.0f %10.0f" % (name, metrics['ips'], metrics['fps']))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark opcode handlers and ROMs")
+    parser.add_argument('roms', nargs='*', default=sorted(glob.glob('roms/*.rom')))
+    parser.add_argument('--calls', type=int, default=20000, help="calls per handler")
+    parser.add_argument('--cycles', type=int, default=200000, help="instructions per ROM")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best is kept")
+    parser.add_argument('--output', default='bench.json', help="file to write the results to")
+    parser.add_argument('--baseline', help="results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = run_suite(args.roms, args.calls, args.cycles, args.repeat)
+    print(report(results))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new in regressions:
+            print("regression: %s %.0f -> %.0f (%.1f%%)" % (name, old, new, 100 * (new / old - 1)))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import json
+import os
+
+# Where analyses and font lookups are kept between runs
+CACHE_DIR = os.environ.get('CHIP8_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'chip8'))
+
+
+def read(path):
+    # JSON data cached at path, None when missing or unreadable
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write(path, data):
+    # Cache data as JSON at path, quietly giving up when it cannot be
+    # written. Written to a temporary file per process and renamed, so
+    # readers, other processes included, never see half a file.
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, path)
+    except OSError:
+        pass
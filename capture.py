@@ -0,0 +1,178 @@
+import argparse
+import bisect
+import struct
+import threading
+import zlib
+from array import array
+from collections import deque
+
+# Capture layout, little endian:
+#   header: magic, instructions per frame
+#   chunks: first frame number, screen count, compressed length, then
+#           zlib compressed frame numbers (4 bytes each) and screens
+#   index: (first frame number, chunk offset) for every chunk
+#   trailer: index offset, index magic
+# A screen, 32 rows of 8 bytes, is shown from its frame until the next
+# screen's frame. Screens that did not change are not stored.
+MAGIC = b'C8V1'
+HEADER = struct.Struct('<4sH')
+CHUNK = struct.Struct('<IHI')
+INDEX = struct.Struct('<II')
+INDEX_MAGIC = b'C8VX'
+TRAILER = struct.Struct('<I4s')
+FRAME_SIZE = 32 * 8
+BLANK_FRAME = bytes(FRAME_SIZE)
+
+
+class Capture:
+    # Writes every frame a CPU publishes to a capture file. The CPU only
+    # queues the frame. A background thread picks up the queue every
+    # interval seconds, and compresses chunks of chunk_size screens with
+    # zlib, which lets go of the GIL, so the CPU keeps its speed.
+
+    def __init__(self, cpu, path, chunk_size=256, interval=0.05):
+        self.cpu = cpu
+        self.chunkSize = chunk_size
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, cpu.ipf))
+        self.interval = interval
+        self.queue = deque()
+        self.stopEvent = threading.Event()
+        # (first frame number, offset) of every chunk
+        self.index = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.push(cpu.front)
+        cpu.frameListeners.append(self.push)
+
+    def push(self, front):
+        # Called by the CPU with every frame it publishes
+        self.queue.append((self.cpu.frames, front[1]))
+
+    def run(self):
+        last = None
+        frames = array('I')
+        screens = []
+        while True:
+            stopping = self.stopEvent.wait(self.interval)
+            while self.queue:
+                frame, data = self.queue.popleft()
+                if data == last:
+                    continue
+                last = data
+                frames.append(frame)
+                screens.append(data)
+                if len(frames) == self.chunkSize:
+                    self.write(frames, screens)
+                    frames = array('I')
+                    screens = []
+            if stopping:
+                break
+        if frames:
+            self.write(frames, screens)
+
+    def write(self, frames, screens):
+        data = zlib.compress(frames.tobytes() + b''.join(screens))
+        self.index.append((frames[0], self.file.tell()))
+        self.file.write(CHUNK.pack(frames[0], len(frames), len(data)) + data)
+
+    def close(self):
+        # Stop capturing, finish writing and add the index
+        if self.push in self.cpu.frameListeners:
+            self.cpu.frameListeners.remove(self.push)
+        self.stopEvent.set()
+        self.thread.join()
+        offset = self.file.tell()
+        self.file.write(b''.join(INDEX.pack(frame, chunk) for frame, chunk in self.index))
+        self.file.write(TRAILER.pack(offset, INDEX_MAGIC))
+        self.file.close()
+
+
+class Reader:
+    # Frame exact access to a capture file
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        magic, self.ipf = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError("Not a chip-8 capture")
+        # first frame number and offset of every chunk
+        self.starts = []
+        self.offsets = []
+        offset, index_magic = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+        if index_magic == INDEX_MAGIC:
+            for frame, chunk in INDEX.iter_unpack(self.data[offset:len(self.data) - TRAILER.size]):
+                self.starts.append(frame)
+                self.offsets.append(chunk)
+        else:
+            # not closed, find the chunks written
+            self.scan()
+        # last chunk decoded, (number, frame numbers, screens)
+        self.cached = None
+
+    def scan(self):
+        offset = HEADER.size
+        while offset + CHUNK.size <= len(self.data):
+            frame, count, length = CHUNK.unpack_from(self.data, offset)
+            if offset + CHUNK.size + length > len(self.data):
+                break
+            self.starts.append(frame)
+            self.offsets.append(offset)
+            offset += CHUNK.size + length
+
+    def __len__(self):
+        return len(self.starts)
+
+    def chunk(self, i):
+        # Frame numbers and screens of chunk i
+        if self.cached is None or self.cached[0] != i:
+            frame, count, length = CHUNK.unpack_from(self.data, self.offsets[i])
+            start = self.offsets[i] + CHUNK.size
+            data = zlib.decompress(self.data[start:start + length])
+            frames = array('I', data[:4 * count])
+            screens = data[4 * count:]
+            self.cached = (i, frames, screens)
+        return self.cached[1], self.cached[2]
+
+    def seek(self, frame):
+        # Screen shown at a frame, 32 rows of 8 bytes
+        i = bisect.bisect_right(self.starts, frame) - 1
+        if i < 0:
+            return BLANK_FRAME
+        frames, screens = self.chunk(i)
+        j = bisect.bisect_right(frames, frame) - 1
+        return screens[j * FRAME_SIZE:(j + 1) * FRAME_SIZE]
+
+    def __iter__(self):
+        # (frame number, screen) for every screen stored
+        for i in range(len(self.starts)):
+            frames, screens = self.chunk(i)
+            for j, frame in enumerate(frames):
+                yield frame, screens[j * FRAME_SIZE:(j + 1) * FRAME_SIZE]
+
+    def last(self):
+        # Frame number of the last screen stored, None when empty
+        if not self.starts:
+            return None
+        return self.chunk(len(self.starts) - 1)[0][-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show a frame from a chip-8 capture")
+    parser.add_argument('capture')
+    parser.add_argument('--frame', type=int, default=None, help="frame to show, the last one by default")
+    args = parser.parse_args()
+
+    reader = Reader(args.capture)
+    frame = args.frame
+    if frame is None:
+        frame = reader.last() or 0
+    rows = memoryview(reader.seek(frame)).cast('Q')
+    print("frame %d:" % frame)
+    for row in rows:
+        print(format(row, '064b').replace('0', '.').replace('1', '#'))
+
+
+if __name__ == "__main__":
+    main()
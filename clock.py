@@ -1,21 +1,93 @@
 import time
 import threading
 
-startTime = time.time()
 
-class clock:
-    def __init__(self, interval, action):
-        self.interval = interval
-        self.action = action
+class FrameScheduler:
+    # Runs a CPU one 60 Hz frame at a time. Each frame executes the CPU's
+    # instructions per frame and ticks its timers once, so game timing does
+    # not depend on the instruction rate.
+    #
+    # speed is a multiple of real time, None runs frames back to back.
+    # Frames are laid out on a fixed schedule, when the host falls behind
+    # up to maxCatchup frames are run at once and the rest are dropped.
+    #
+    # input, when given, has its apply() called before every frame and
+    # feeds key transitions to the CPU, see replay.Recorder. Frames run
+    # from translator's compiled blocks when given.
+
+    def __init__(self, cpu, rate=60, speed=1, max_catchup=4, input=None, translator=None):
+        self.cpu = cpu
+        self.input = input
+        self.translator = translator
+        self.rate = rate
+        self.speed = speed
+        self.maxCatchup = max_catchup
+        self.nextFrame = None
+        self.dropped = 0
         self.stopEvent = threading.Event()
-        thread = threading.Thread(target=self.__setInterval)
-        thread.start()
+        self.thread = None
+
+    @property
+    def interval(self):
+        return 1 / (self.rate * self.speed)
+
+    def run_frame(self):
+        if self.input is not None:
+            self.input.apply()
+        if self.translator is not None:
+            self.translator.run_frame()
+        else:
+            self.cpu.run_frame()
+
+    def blocked(self):
+        # Nothing to run until a key goes down
+        return self.cpu.blocked() and not (self.input is not None and self.input.pending)
+
+    def advance(self, now=None):
+        # Run the frames that are due, returns how many ran
+        if self.speed is None:
+            self.run_frame()
+            return 1
+        if now is None:
+            now = time.perf_counter()
+        if self.nextFrame is None:
+            self.nextFrame = now
+        if now < self.nextFrame:
+            return 0
+
+        interval = self.interval
+        due = int((now - self.nextFrame) / interval) + 1
+        if due > self.maxCatchup:
+            self.dropped += due - self.maxCatchup
+            self.nextFrame += (due - self.maxCatchup) * interval
+            due = self.maxCatchup
+        for _ in range(due):
+            self.run_frame()
+        self.nextFrame += due * interval
+        return due
+
+    def wait(self):
+        # Sleep until the next frame is due, False once cancelled
+        cpu = self.cpu
+        if self.blocked():
+            cpu.keyEvent.clear()
+            if self.blocked():
+                cpu.keyEvent.wait()
+            self.nextFrame = None
+            return not self.stopEvent.is_set()
+        if self.speed is None or self.nextFrame is None:
+            return not self.stopEvent.is_set()
+        return not self.stopEvent.wait(max(self.nextFrame - time.perf_counter(), 0))
+
+    def run(self):
+        while self.wait():
+            self.advance()
 
-    def __setInterval(self):
-        nextTime = time.time() + self.interval
-        while not self.stopEvent.wait(nextTime-time.time()):
-            nextTime += self.interval
-            self.action()
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
     def cancel(self):
         self.stopEvent.set()
+        self.cpu.keyEvent.set()
@@ -1,30 +1,63 @@
 import logging
+import threading
+import time
+from array import array
 from clock import *
-from random import randint
+import random
 
-logging.basicConfig(level=logging.DEBUG)
+# Blank screen, 32 rows of 64 pixels packed one bit per pixel,
+# the most significant bit is x = 0
+BLANK = array('Q', [0] * 32)
+
+# Sprite bytes positioned on a framebuffer row, SPRITE_ROWS[x][byte].
+# Pixels past the right edge are clipped, x of 64 and over draws nothing.
+SPRITE_ROWS = [[(byte << 56) >> x for byte in range(256)] for x in range(64)] + [[0] * 256] * 192
+
+# ROMs load at 0x200 and fill at most the rest of memory
+ROM_START = 0x200
+ROM_SIZE = 4096 - ROM_START
+
+# Longest loop body, in bytes, checked for polling
+POLL_LOOP_SIZE = 14
+
+# Loop bodies seen so far -> whether they only poll the timers or keys
+poll_loops = {}
 
 
 class CPU:
-    memory = [0] * 4096
-    register = [0] * 16
-    I = 0
-    frameBuffer = [0] * 64 * 32
-    stack = []
-    input = [0] * 16
-    instruction = 0
-
-    # Timers
-    delayTimer = 0
-    soundTimer = 0
-    flush = False
-
-    # Clock
-    speed = 10  # Hz
-    clock = None
-
-    # Counters
-    pc = 0x200
+    # Every machine owns its state
+    __slots__ = (
+        'memory', 'register', 'I', 'frameBuffer', 'stack', 'input', 'instruction',
+        # Timers
+        'delayTimer', 'soundTimer', 'flush',
+        # Clock
+        'ipf', 'clock', 'running',
+        # Last unknown opcode hit, if any
+        'trap',
+        # Idle detection: nothing changes before the next timer tick,
+        # the last polling loop seen, waiting in Fx0A and its notification,
+        # and whether run() skips to the tick when idle
+        'idle', 'idleLoop', 'waitKey', 'keyEvent', 'skipIdle',
+        # Counters
+        'pc', 'cycles', 'frames',
+        # Control lines
+        # 0 - flush display
+        # 1 - sound timer ran out
+        'control',
+        # Decode table in use, instrumented while tracing
+        'decoded',
+        # Random numbers for Cxkk, seeded from seed on every reset
+        'seed', 'rng',
+        # Last complete frame, (sequence, rows), its notification and
+        # the functions called with every new one
+        'front', 'frameReady', 'frameListeners',
+        # Frames the sound timer ran in, never reset, so the renderer can
+        # tell a beep started and ran out since it last looked
+        'sounds',
+        # Functions called when memory is replaced as a whole, on reset,
+        # loading a ROM or restoring a snapshot
+        'memoryListeners',
+    )
 
     # Font
     font = [
@@ -46,357 +79,405 @@ class CPU:
         0xF0, 0x80, 0xF0, 0x80, 0x80   # F
     ]
 
-    # Control lines
-    # 0 - flush display
-    # 1 - beep
-    control = [0] * 16
-
-    def __init__(self):
-
-        self.funcmap = {
-            0x0000: self._0000,
-            0x00e0: self._00e0,
-            0x3000: self._3000,
-            0x4000: self._4000,
-            0x8000: self._8000,
-            0x8ff0: self._8FF0,
-            0x8ff1: self._8FF1,
-            0x8ff2: self._8FF2,
-            0x8ff3: self._8FF3,
-            0x8ff4: self._8FF4,
-            0x8ff5: self._8FF5,
-            0x8ff6: self._8FF6,
-            0x8ff7: self._8FF7,
-            0x8ffe: self._8FFE,
-            0xc000: self._C000,
-            0xa000: self._A000,
-            0xf000: self._F000,
-            0xf01e: self._F01E,
-            0xe000: self._E000,
-            0xe0a1: self._E0A1,
-            0xf033: self._F033,
-            0xf065: self._F065,
-            0xf029: self._F029,
-            0xf055: self._F055,
-            0x6000: self._6000,
-            0x5000: self._5000,
-            0xd000: self._D000,
-            0xf00a: self._F00A,
-            0x1000: self._1000,
-            0x2000: self._2000,
-            0x7000: self._7000,
-            0x00ee: self._00ee,
-            0xf015: self._F015,
-            0xf007: self._F007,
-            0xf018: self._F018
-        }
-
-        # Loading font in memory
-        for i in range(len(self.font)):
-            # load 80-char font set
-            self.memory[i] = self.font[i]
-
+    # Opcode patterns and the operands each handler takes.
+    # 0x0, 0xE and 0xF opcodes are keyed on op & 0xf0ff,
+    # 0x8 opcodes on (op & 0xf00f) + 0xff0, the rest on op & 0xf000.
+    opcodes = {
+        0x00e0: ('_00e0', ()),
+        0x00ee: ('_00ee', ()),
+        0x1000: ('_1000', ('nnn',)),
+        0x2000: ('_2000', ('nnn',)),
+        0x3000: ('_3000', ('x', 'kk')),
+        0x4000: ('_4000', ('x', 'kk')),
+        0x5000: ('_5000', ('x', 'y')),
+        0x6000: ('_6000', ('x', 'kk')),
+        0x7000: ('_7000', ('x', 'kk')),
+        0x8ff0: ('_8FF0', ('x', 'y')),
+        0x8ff1: ('_8FF1', ('x', 'y')),
+        0x8ff2: ('_8FF2', ('x', 'y')),
+        0x8ff3: ('_8FF3', ('x', 'y')),
+        0x8ff4: ('_8FF4', ('x', 'y')),
+        0x8ff5: ('_8FF5', ('x', 'y')),
+        0x8ff6: ('_8FF6', ('x', 'y')),
+        0x8ff7: ('_8FF7', ('x', 'y')),
+        0x8ffe: ('_8FFE', ('x', 'y')),
+        0xa000: ('_A000', ('nnn',)),
+        0xc000: ('_C000', ('x', 'kk')),
+        0xd000: ('_D000', ('x', 'y', 'n')),
+        0xe0a1: ('_E0A1', ('x',)),
+        0xf007: ('_F007', ('x',)),
+        0xf00a: ('_F00A', ('x',)),
+        0xf015: ('_F015', ('x',)),
+        0xf018: ('_F018', ('x',)),
+        0xf01e: ('_F01E', ('x',)),
+        0xf029: ('_F029', ('x',)),
+        0xf033: ('_F033', ('x',)),
+        0xf055: ('_F055', ('x',)),
+        0xf065: ('_F065', ('x',)),
+    }
+
+    operands = {
+        'x': lambda op: (op & 0x0f00) >> 8,
+        'y': lambda op: (op & 0x00f0) >> 4,
+        'n': lambda op: op & 0x000f,
+        'kk': lambda op: op & 0x00ff,
+        'nnn': lambda op: op & 0x0fff,
+    }
+
+    # Decoded opcodes, shared by every CPU
+    # table[op] -> (handler, operands)
+    table = None
+
+    def __init__(self, seed=None):
+        # bytearrays keep memory and registers to 8 bits
+        self.memory = bytearray(4096)
+        self.register = bytearray(16)
+        self.frameBuffer = array('Q', BLANK)
+        self.stack = []
+        self.input = bytearray(16)
+        self.control = bytearray(16)
+        self.keyEvent = threading.Event()
+        self.front = (0, BLANK.tobytes())
+        self.sounds = 0
+        self.frameReady = threading.Condition()
+        self.frameListeners = []
+        self.memoryListeners = []
+
+        self.ipf = 10  # instructions per 60 Hz frame
+        self.skipIdle = True
+        self.clock = None
+        self.running = False
+
+        if CPU.table is None:
+            CPU.table = CPU.decode()
+        self.decoded = CPU.table
+
+        # a run can be repeated from its seed, even when it was not chosen
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        self.reset()
         logging.debug("CPU initialized.")
 
-    def _0000(self):
-        extracted_op = self.instruction & 0xf0ff
-        if extracted_op in self.funcmap:
-            try:
-                self.funcmap[extracted_op]()
-            except:
-                logging.error("Instruction error: %X, op: %X" % (self.instruction, extracted_op))
-        else:
-            logging.warn("Unknown instruction: %X, op: %X" % (self.instruction, extracted_op))
-            self.stop();
-
-    def _1000(self):
+    @classmethod
+    def pattern(cls, op):
+        group = op & 0xf000
+        if group in (0x0000, 0xe000, 0xf000):
+            return op & 0xf0ff
+        if group == 0x8000:
+            return (op & 0xf00f) + 0xff0
+        return group
+
+    @classmethod
+    def decode(cls):
+        # Build the decode table for all 65536 opcodes,
+        # unknown opcodes go to the trap handler
+        table = []
+        for op in range(0x10000):
+            pattern = cls.pattern(op)
+            if pattern in cls.opcodes:
+                name, operands = cls.opcodes[pattern]
+                table.append((getattr(cls, name), tuple(cls.operands[o](op) for o in operands)))
+            else:
+                table.append((cls._trap, (op,)))
+        return table
+
+    def _trap(self, op):
+        logging.warning("Unknown instruction: %X", op)
+        self.trap = op
+        self.stop()
+
+    def _1000(self, nnn):
         # 1nnn - JMP
         # Jump to location nnn.
-        logging.info("Jumping to %X", self.instruction % 0x0fff)
-        self.pc = self.instruction & 0x0fff
+        if nnn < self.pc and self.pc - nnn <= POLL_LOOP_SIZE + 2:
+            self.check_idle(nnn)
+        else:
+            self.idleLoop = None
+        self.pc = nnn
 
-    def _2000(self):
+    def _2000(self, nnn):
         # 2nnn
         # Call a subroutine at nnn
-        logging.info('Calling subroutine at %X', self.instruction & 0x0fff)
         self.stack.append(self.pc)
-        self.pc = self.instruction & 0x0fff
+        self.pc = nnn
 
-    def _3000(self):
+    def _3000(self, x, kk):
         # Skip next instruction if Vx = kk.
-        logging.info('Skip next instruction if Vx(I:%X V:%X) = kk(%X).', self.vx, self.register[self.vx], (self.instruction & 0x00ff))
-        if self.register[self.vx] == (self.instruction & 0x00ff):
+        if self.register[x] == kk:
             self.pc += 2
 
-    def _4000(self):
+    def _4000(self, x, kk):
         # Skip next instruction if Vx != kk.
-        logging.info("Skip next instruction if Vx(I:%X V:%X) != kk(%X).", self.vx, self.register[self.vx], (self.instruction & 0x00ff))
-        if self.register[self.vx] != (self.instruction & 0x00ff):
+        if self.register[x] != kk:
             self.pc += 2
 
-    def _5000(self):
+    def _5000(self, x, y):
         # skip next instruction if Vx = Vy
-        logging.info("Skip next instruction if Vx(I:%X V:%X) = Vy(I:%X V:%X).", self.vx, self.register[self.vx], self.vy, self.register[self.vy])
-        if self.register[self.vx] == self.register[self.vy]:
+        if self.register[x] == self.register[y]:
             self.pc += 2
 
-    def _7000(self):
+    def _7000(self, x, kk):
         # 7xkk
         # Set Vx = Vx + kk.
-        logging.info('Adding %X to VX', self.instruction & 0xff)
-        self.register[self.vx] += (self.instruction & 0xff)
-
-    def _8000(self):
-        extracted_op = self.instruction & 0xf00f
-        extracted_op += 0xff0
-        if extracted_op in self.funcmap:
-            try:
-                self.funcmap[extracted_op]()
-            except:
-                logging.error("Instruction error: %X, op: %X" % (self.instruction, extracted_op))
-        else:
-            logging.warn("Unknown instruction: %X, op: %X" % (self.instruction, extracted_op))
-            self.stop();
+        self.register[x] = (self.register[x] + kk) & 0xff
 
-    def _8FF0(self):
+    def _8FF0(self, x, y):
         # Set Vx = Vy.
-        logging.info("Set Vx = Vy.")
-        self.register[self.vx] = self.register[self.vy]
-        self.register[self.vx] &= 0xff
+        self.register[x] = self.register[y]
 
-    def _8FF1(self):
+    def _8FF1(self, x, y):
         # Set Vx = Vx OR Vy.
-        logging.info("Set Vx = Vx OR Vy.")
-        self.register[self.vx] |= self.register[self.vy]
-        self.register[self.vx] &= 0xff
+        self.register[x] |= self.register[y]
 
-    def _8FF2(self):
+    def _8FF2(self, x, y):
         # Set Vx = Vx AND Vy.
-        logging.info("Set Vx = Vx AND Vy.")
-        self.register[self.vx] &= self.register[self.vy]
-        self.register[self.vx] &= 0xff
+        self.register[x] &= self.register[y]
     
-    def _8FF3(self):
+    def _8FF3(self, x, y):
         # Set Vx = Vx XOR Vy.
-        logging.info("Set Vx = Vx XOR Vy.")
-        self.register[self.vx] ^= self.register[self.vy]
-        self.register[self.vx] &= 0xff
+        self.register[x] ^= self.register[y]
 
-    def _8FF4(self):
+    def _8FF4(self, x, y):
         # Set Vx = Vx + Vy, set VF = carry.
-        logging.info("Set Vx = Vx + Vy, set VF = carry.")
-        if self.register[self.vx] + self.register[self.vy] > 0xff:
+        if self.register[x] + self.register[y] > 0xff:
             self.register[0xf] = 1
         else:
             self.register[0xf] = 0
-        self.register[self.vx] += self.register[self.vy]
-        self.register[self.vx] &= 0xff
+        self.register[x] = (self.register[x] + self.register[y]) & 0xff
 
-    def _8FF5(self):
+    def _8FF5(self, x, y):
         # Set Vx = Vx - Vy, set VF = NOT borrow.
-        logging.info("Set Vx = Vx - Vy, set VF = NOT borrow.")
-        if self.register[self.vy] > self.register[self.vx]:
+        if self.register[y] > self.register[x]:
             self.register[0xf] = 0
         else:
             self.register[0xf] = 1
-        self.register[self.vx] = self.register[self.vx] - self.register[self.vy]
-        self.register[self.vx] &= 0xff
+        self.register[x] = (self.register[x] - self.register[y]) & 0xff
 
-    def _8FF6(self):
+    def _8FF6(self, x, y):
         # Set Vx = Vx SHR 1.
-        logging.info("Set Vx = Vx SHR 1.")
-        self.register[0xf] = self.register[self.vx] & 0x0001
-        self.register[self.vx] = self.register[self.vx] >> 1
+        self.register[0xf] = self.register[x] & 0x0001
+        self.register[x] = self.register[x] >> 1
 
-    def _8FF7(self):
+    def _8FF7(self, x, y):
         # Set Vx = Vy - Vx, set VF = NOT borrow.
-        logging.info("Set Vx = Vy - Vx, set VF = NOT borrow.")
-        if self.register[self.vx] > self.register[self.vy]:
+        if self.register[x] > self.register[y]:
             self.register[0xf] = 0
         else:
             self.register[0xf] = 1
-        self.register[self.vx] = self.register[self.vy] - self.register[self.vx]
-        self.register[self.vx] &= 0xff
+        self.register[x] = (self.register[y] - self.register[x]) & 0xff
 
-    def _8FFE(self):
+    def _8FFE(self, x, y):
         # Set Vx = Vx SHL 1.
-        logging.info("Set Vx = Vx SHL 1.")
-        self.register[0xf] = (self.register[self.vx] & 0x00f0) >> 7
-        self.register[self.vx] = self.register[self.vx] << 1
-        self.register[self.vx] &= 0xff
+        self.register[0xf] = (self.register[x] & 0x00f0) >> 7
+        self.register[x] = (self.register[x] << 1) & 0xff
 
     def _00e0(self):
         # 00E0 - CLS
         # Clear the display.
-        logging.info('Clearing Screen')
-        self.frameBuffer = [0] * 64 * 32
+        self.frameBuffer[:] = BLANK
         self.control[0] = True
 
     def _00ee(self):
         # RET
         # Return from a subroutine.
-        logging.info('Return from subroutine')
         self.pc = self.stack.pop()
 
-    def _A000(self):
+    def _A000(self, nnn):
         # Annn - LD I, addr
         # Set I = nnn.
         # The value of register I is set to nnn.
-        logging.info("Sets I to the address %X.", self.instruction & 0x0fff)
-        self.I = self.instruction & 0x0fff
+        self.I = nnn
 
-    def _C000(self):
+    def _C000(self, x, kk):
         # Cxkk - RND Vx, byte
         # Set Vx = random AND kk.
-        logging.info('Generate Random Number')
-        self.register[self.vx] = randint(0, 255) & (self.instruction & 0x00ff)
-
-    def _E000(self):
-        extracted_op = self.instruction & 0xf0ff
-        if extracted_op in self.funcmap:
-            try:
-                self.funcmap[extracted_op]()
-            except:
-                logging.error("Instruction error: %X, op: %X" % (self.instruction, extracted_op))
-        else:
-            logging.warn("Unknown instruction: %X, op: %X" % (self.instruction, extracted_op))
-            self.stop();
+        self.register[x] = self.rng.getrandbits(8) & kk
 
-    def _E0A1(self):
+    def _E0A1(self, x):
         # ExA1 SKNP Vx
         # Skip next instruction if key with the value of Vx is not pressed.
-        logging.info("Skip next instruction if key with the value of Vx is not pressed.")
-        if self.input[self.vx] == 0:
+        if self.input[x] == 0:
             self.pc += 2
 
-    def _F000(self):
-        extracted_op = self.instruction & 0xf0ff
-        if extracted_op in self.funcmap:
-            try:
-                self.funcmap[extracted_op]()
-            except:
-                logging.error("Instruction error: %X, op: %X" % (self.instruction, extracted_op))
-        else:
-            logging.warn("Unknown instruction: %X, op: %X" % (self.instruction, extracted_op))
-            self.stop();
-
-    def _F007(self):
+    def _F007(self, x):
         # Set Vx = delay timer value.
-        logging.info('Set Vx = delay timer')
-        self.register[self.vx] = self.delayTimer
+        self.register[x] = self.delayTimer
 
-    def _F015(self):
+    def _F015(self, x):
         # Set delay timer = Vx.
-        logging.info('Set delay timer = Vx')
-        self.delayTimer = self.register[self.vx]
+        self.delayTimer = self.register[x]
 
-    def _F018(self):
+    def _F018(self, x):
         # Set sound timer = Vx.
-        logging.info("Set sound timer = Vx.")
-        self.soundTimer = self.register[self.vx]
+        self.soundTimer = self.register[x]
     
-    def _F01E(self):
+    def _F01E(self, x):
         # Set I = I + Vx.
-        logging.info("Set I = I + Vx.")
-        self.I += self.register[self.vx]
+        self.I += self.register[x]
         if self.I > 0xfff:
             self.register[0xf] = 1
             self.I &= 0xfff
         else:
             self.register[0xf] = 0
 
-    def _F033(self):
+    def _F033(self, x):
         # Store BCD representation of Vx in memory locations I, I+1, and I+2.
-        logging.info("Storing BCD to Memory")
-        self.memory[self.I] = int(self.register[self.vx] / 100)
-        self.memory[self.I + 1] = int((self.register[self.vx] % 100) / 10)
-        self.memory[self.I + 2] = int(self.register[self.vx] % 10)
+        self.memory[self.I] = self.register[x] // 100
+        self.memory[(self.I + 1) & 0xfff] = (self.register[x] // 10) % 10
+        self.memory[(self.I + 2) & 0xfff] = self.register[x] % 10
 
-    def _F055(self):
+    def _F055(self, x):
         # Store registers V0 through Vx in memory starting at location I.
-        logging.info("Store registers V0 through Vx in memory starting at location I.")
         i = 0
-        while i <= self.vx:
-            self.memory[self.I + i] = self.register[i]
+        while i <= x:
+            self.memory[(self.I + i) & 0xfff] = self.register[i]
             i += 1
 
-    def _F065(self):
+    def _F065(self, x):
         # Read registers V0 through Vx from memory starting at location I.
-        logging.info("Fills V0 to VX with values from memory starting at address I.")
         i = 0
-        while i <= self.vx:
-            self.register[i] = self.memory[self.I + i]
+        while i <= x:
+            self.register[i] = self.memory[(self.I + i) & 0xfff]
             i += 1
 
-    def _F029(self):
+    def _F029(self, x):
         # Set I = location of sprite for digit Vx.
-        logging.info('Set index to point to location of vx')
-        try:
-            self.I = (5 * (self.register[self.vx])) & 0xfff
-        except Exception as e:
-            logging.error(e)
+        self.I = (5 * (self.register[x])) & 0xfff
 
-    def _6000(self):
+    def _6000(self, x, kk):
         # Set Vx = kk.
-        logging.info('Set vx (I: %X) to kk(%X)', self.vx, self.instruction & 0x00ff)
-        self.register[self.vx] = self.instruction & 0x00ff
+        self.register[x] = kk
 
-    def _D000(self):
+    def _D000(self, x, y, n):
         # Display n-byte sprite starting at memory location I at (Vx, Vy), set VF = collision.
-        logging.info('Display sprite at I')
-        self.register[0xf] = 0
-        x = self.register[self.vx] & 0xff
-        y = self.register[self.vy] & 0xff
-
-        height = self.instruction & 0x000f
-        row = 0
-        while row < height:
-            curr_row = self.memory[row + self.I]
-            pixel_offset = 0
-            while pixel_offset < 8:
-                loc = x + pixel_offset + ((y + row) * 64)
-                pixel_offset += 1
-                if (y + row) >= 32 or (x + pixel_offset - 1) >= 64:
-                    # ignore pixels outside the screen
-                    continue
-                mask = 1 << 8 - pixel_offset
-                curr_pixel = (curr_row & mask) >> (8 - pixel_offset)
-                self.frameBuffer[loc] ^= curr_pixel
-                if self.frameBuffer[loc] == 0:
-                    self.register[0xf] = 1
-                else:
-                    self.register[0xf] = 0
-            row += 1
+        rows = SPRITE_ROWS[self.register[x]]
+        y = self.register[y]
+        sprite = self.memory[self.I:self.I + n]
+        if len(sprite) < n:
+            # wraps around the end of memory
+            sprite += self.memory[:n - len(sprite)]
+
+        # pixels outside the screen are clipped
+        frameBuffer = self.frameBuffer
+        collision = 0
+        for row, byte in zip(range(y, 32), sprite):
+            mask = rows[byte]
+            collision |= frameBuffer[row] & mask
+            frameBuffer[row] ^= mask
+        self.register[0xf] = 1 if collision else 0
         self.control[0] = True
 
-
-    def _F00A(self):
+    def _F00A(self, x):
         # Wait for a key press, store the value of the key in Vx.
-        logging.info('Wait for keypress')
         key = -1
         for i in range(len(self.input)):
             if self.input[i] == 1:
                 key = i
         if key >= 0:
-            self.input[self.vx] = key
+            self.register[x] = key
+            self.waitKey = False
         else:
             self.pc -= 2
+            self.waitKey = True
+            self.idle = True
+
+    # Handlers that can make up a loop polling the timers or keys
+    poll_ops = ('_3000', '_4000', '_5000', '_6000', '_E0A1', '_F007')
+
+    @classmethod
+    def is_poll_loop(cls, body):
+        # The loop only sets registers from constants, the delay timer and
+        # keys and tests them, so every pass gives the same result until a
+        # timer ticks or a key changes
+        for i in range(0, len(body) - 1, 2):
+            handler, _ = cls.table[(body[i] << 8) | body[i + 1]]
+            if handler.__name__ not in cls.poll_ops:
+                return False
+        return True
+
+    def check_idle(self, start):
+        # Backward jump from pc - 2 to start
+        if start == self.pc - 2:
+            # jump to self
+            self.idle = True
+            return
+        body = bytes(self.memory[start:self.pc - 2])
+        poll = poll_loops.get(body)
+        if poll is None:
+            poll = poll_loops[body] = self.is_poll_loop(body)
+        if not poll:
+            self.idleLoop = None
+        elif self.idleLoop == start:
+            # second pass in a row, the loop was run from the top
+            self.idle = True
+        else:
+            self.idleLoop = start
+
+    def blocked(self):
+        # Waiting for a key with no timer left to count down
+        return self.waitKey and not (self.delayTimer or self.soundTimer or any(self.input))
+
+    def key_down(self, key):
+        self.input[key] = 1
+        self.keyEvent.set()
+
+    def key_up(self, key):
+        self.input[key] = 0
+
+    def publish(self):
+        # Hand the framebuffer to the renderer as a complete frame. front is
+        # replaced by a single assignment, so readers never see a torn frame.
+        self.control[0] = False
+        self.front = front = (self.front[0] + 1, self.frameBuffer.tobytes())
+        for listener in self.frameListeners:
+            listener(front)
+        with self.frameReady:
+            self.frameReady.notify_all()
+
+    def wait_frame(self, sequence, timeout=None):
+        # Block until a frame newer than sequence is published. Returns
+        # (sequence, rows) of the newest frame, or None after timeout seconds.
+        with self.frameReady:
+            self.frameReady.wait_for(lambda: self.front[0] > sequence, timeout)
+        front = self.front
+        return front if front[0] > sequence else None
+
+    def frame_view(self):
+        # Read-only view of the framebuffer rows, without copying
+        return memoryview(self.frameBuffer).toreadonly()
+
+    def pixel(self, x, y):
+        return (self.frameBuffer[y] >> (63 - x)) & 1
 
     def load_rom(self, rom):
         logging.debug('Resetting CPU')
-        logging.debug("Loading %s..." % rom)
+        logging.debug("Loading %s...", rom)
         romdata = open(rom, 'rb').read()
-        for index, val in enumerate(romdata):
-            self.memory[0x200 + index] = val
+        if len(romdata) > ROM_SIZE:
+            raise ValueError("ROM is %d bytes, at most %d fit in memory" % (len(romdata), ROM_SIZE))
+        self.memory[ROM_START:ROM_START + len(romdata)] = romdata
+        self.memory_replaced()
         logging.debug("ROM Loaded")
 
+    def memory_replaced(self):
+        for listener in self.memoryListeners:
+            listener()
+
     def reset(self):
-        self.memory = [0] * 4096
-        self.register = [0] * 16
+        # Clear the machine in place, keeping its buffers
+        self.memory[:] = bytes(len(self.memory))
+        # Loading font in memory
+        self.memory[:len(self.font)] = bytes(self.font)
+        self.memory_replaced()
+        self.register[:] = bytes(len(self.register))
         self.I = 0
-        self.frameBuffer = [0] * 64 * 32
-        self.stack = []
-        self.input = [0] * 16
+        self.frameBuffer[:] = BLANK
+        self.stack.clear()
+        self.rng.seed(self.seed)
+        self.input[:] = bytes(len(self.input))
         self.instruction = 0
 
         # Timers
@@ -406,46 +487,101 @@ class CPU:
 
         # Counters
         self.pc = 0x200
+        self.cycles = 0
+        self.frames = 0
+        self.trap = None
+        self.idle = False
+        self.idleLoop = None
+        self.waitKey = False
 
         # Control lines
         # 0 - flush display
-        self.control = [0] * 16
+        self.control[:] = bytes(len(self.control))
+        # show the blank screen
+        self.publish()
 
         logging.debug("CPU is reset.")
 
-    def start(self):
-        self.clock = clock(1 / self.speed, self.cycle)
+    def start(self, input=None, translator=None, speed=1):
+        # Run on a background thread at speed times real time, or as fast
+        # as possible for None. input feeds the keys when given, see
+        # FrameScheduler
+        self.running = True
+        self.clock = FrameScheduler(self, speed=speed, input=input, translator=translator)
+        self.clock.start()
 
     def stop(self):
+        self.running = False
         if self.clock is not None:
             self.clock.cancel()
 
-    def cycle(self):
-        self.instruction = (self.memory[self.pc] << 8) | self.memory[self.pc + 1]
-
-        #
-        # TODO: process this opcode here
-        #
-        self.vx = (self.instruction & 0x0f00) >> 8
-        self.vy = (self.instruction & 0x00f0) >> 4
-        self.pc += 2
-
-        # 2. check ops, lookup and execute
-        extracted_op = self.instruction & 0xf000
-        if extracted_op in self.funcmap:
-            try:
-                self.funcmap[extracted_op]()
-            except:
-                logging.error("Instruction error: %X, op: %X" % (self.instruction, extracted_op))
-        else:
-            logging.warn("Unknown instruction: %X, op: %X" % (self.instruction, extracted_op))
-            self.stop();
-
-
-        # decrement timers
+    def run(self, cycles=None, until_pc=None, max_time=None):
+        # Execute synchronously as fast as the host allows, without the clock.
+        # Stops after cycles instructions, when pc reaches until_pc, after
+        # max_time seconds, on a trap or when blocked waiting for a key.
+        # Returns the instructions executed, counting the ones skipped
+        # while idle. The timers tick every ipf instructions.
+        if cycles is None:
+            cycles = float('inf')
+        if max_time is not None:
+            deadline = time.perf_counter() + max_time
+        executed = 0
+        self.running = True
+        while self.running and executed < cycles:
+            # the rest of the current frame
+            n = min(self.ipf - self.cycles % self.ipf, cycles - executed)
+            done = 0
+            start = self.cycles
+            while done < n and self.running and self.pc != until_pc:
+                self.cycle()
+                done += 1
+                if self.idle:
+                    self.idle = False
+                    if self.skipIdle:
+                        # nothing changes before the next tick, skip the rest of the frame
+                        done = n
+            # a debugger stopping before an instruction takes its cycle back
+            self.cycles += done
+            executed += self.cycles - start
+            if self.cycles != start and not self.cycles % self.ipf:
+                self.tick_timers()
+            if done < n or self.blocked():
+                break
+            if max_time is not None and time.perf_counter() >= deadline:
+                break
+        return executed
+
+    def fast_forward(self, cycles):
+        # Let cycles pass while blocked, only the counters change
+        self.cycles += cycles
+        self.frames = self.cycles // self.ipf
+
+    def run_frame(self):
+        # Run to the end of the current frame
+        return self.run(self.ipf - self.cycles % self.ipf)
+
+    def tick_timers(self):
+        # decrement timers and publish what was drawn, once per 60 Hz frame
+        if self.control[0]:
+            self.publish()
         if self.delayTimer > 0:
             self.delayTimer -= 1
         if self.soundTimer > 0:
             self.soundTimer -= 1
+            self.sounds += 1
             if self.soundTimer == 0:
                 self.control[1] = True
+        self.frames += 1
+
+    def cycle(self):
+        # pc wraps at the end of memory, a skip may have taken it past
+        pc = self.pc & 0xfff
+        self.instruction = (self.memory[pc] << 8) | self.memory[(pc + 1) & 0xfff]
+        self.pc = (pc + 2) & 0xfff
+
+        # lookup the decoded opcode and execute
+        handler, operands = self.decoded[self.instruction]
+        try:
+            handler(self, *operands)
+        except:
+            logging.error("Instruction error: %X", self.instruction)
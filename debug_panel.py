@@ -0,0 +1,145 @@
+import time
+
+import pygame
+
+# Characters pre-rendered into the glyph atlas
+GLYPHS = '0123456789ABCDEF '
+
+# Heatmap colours, black through red to yellow
+HEAT_PALETTE = [(min(2 * i, 255), max(2 * i - 255, 0), 0) for i in range(256)]
+
+
+class DebugPanel:
+    def __init__(self, surface, font, origin, size, scale, refresh=10, color=(255, 255, 255), background=(0, 0, 0)):
+        self.surface = surface
+        self.font = font
+        self.origin = origin
+        self.size = size
+        self.scale = scale
+        self.color = color
+        self.background = background
+        self.visible = True
+        # Redraws per second, independent of the emulation speed
+        self.interval = 1 / refresh
+        self.next_update = 0
+
+        self.glyphs = {c: font.render(c, False, color) for c in GLYPHS}
+        self.glyph_width = max(g.get_width() for g in self.glyphs.values())
+        self.glyph_height = max(g.get_height() for g in self.glyphs.values())
+
+        # field -> value currently on screen
+        self.shown = {}
+        self.fields = self.layout()
+
+        # When set, a profiler whose hot addresses are drawn instead of the fields
+        self.profiler = None
+        self.heat = pygame.Surface((64, 64), depth=8)
+        self.heat.set_palette(HEAT_PALETTE)
+        cell = max(min(size[0], size[1] - 2 * scale) // 64, 1)
+        self.heatScaled = pygame.Surface((64 * cell, 64 * cell), depth=8)
+        self.heatScaled.set_palette(HEAT_PALETTE)
+
+    def layout(self):
+        # field -> (value position, width in characters, (label, label position))
+        x, y = self.origin
+        s = self.scale
+        fields = {}
+        for i in range(16):
+            pos = (x + 6 * s * (i % 4), y + 2 * s + 2 * s * (i // 4))
+            fields['V%X' % i] = pos, 2, "V%X:" % i
+        fields['stack'] = (x, y + 12 * s), self.size[0] // self.glyph_width, None
+        for i in range(16):
+            pos = (x + 6 * s * (i % 4), y + 15 + 14 * s + 2 * s * (i // 4))
+            fields['K%X' % i] = pos, 1, "K%X:" % i
+        fields['I'] = (x, y + 24 * s), 3, "I:"
+        fields['pc'] = (x + 12 * s, y + 24 * s), 3, "PC:"
+        fields['delay'] = (x, y + 26 * s), 2, "Delay:"
+        fields['sound'] = (x + 12 * s, y + 26 * s), 2, "Sound:"
+
+        # values go right after their labels
+        for name, (pos, width, label) in fields.items():
+            if label is not None:
+                text = self.font.render(label + ' ', False, self.color)
+                fields[name] = (pos[0] + text.get_width(), pos[1]), width, (text, pos)
+        return fields
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.clear()
+
+    def show_heatmap(self, profiler):
+        # Overlay the addresses profiler counted, None goes back to the fields
+        self.profiler = profiler
+        self.clear()
+
+    def clear(self):
+        self.surface.fill(self.background, (self.origin, self.size))
+        self.shown.clear()
+        self.next_update = 0
+
+    def draw_labels(self):
+        x, y = self.origin
+        s = self.scale
+        for text, pos in (('registers', (x, y)), ('stack', (x, y + 10 * s)), ('inputs', (x, y + 14 * s))):
+            self.surface.blit(self.font.render(text, False, self.color), pos)
+        for pos, width, label in self.fields.values():
+            if label is not None:
+                self.surface.blit(*label)
+
+    def values(self, cpu):
+        values = {}
+        for i in range(16):
+            values['V%X' % i] = "%02X" % cpu.register[i]
+            values['K%X' % i] = "%X" % cpu.input[i]
+        values['stack'] = " ".join("%X" % x for x in cpu.stack)
+        values['I'] = "%03X" % cpu.I
+        values['delay'] = "%02X" % cpu.delayTimer
+        values['sound'] = "%02X" % cpu.soundTimer
+        values['pc'] = "%03X" % cpu.pc
+        return values
+
+    def draw_heatmap(self):
+        # One cell per address, 64 addresses a row
+        x, y = self.origin
+        pixels = self.heat.get_buffer()
+        pitch = self.heat.get_pitch()
+        heat = self.profiler.heat()
+        for row in range(64):
+            pixels.write(heat[64 * row:64 * row + 64], row * pitch)
+        del pixels
+        pygame.transform.scale(self.heat, self.heatScaled.get_size(), self.heatScaled)
+        self.surface.blit(self.heatScaled, (x, y + 2 * self.scale))
+
+    def draw(self, pos, width, text):
+        x, y = pos
+        self.surface.fill(self.background, (x, y, width * self.glyph_width, self.glyph_height))
+        for c in text[:width]:
+            self.surface.blit(self.glyphs[c], (x, y))
+            x += self.glyph_width
+
+    def update(self, cpu, now=None):
+        # Redraw the fields whose value changed, returns True if anything was drawn
+        if not self.visible:
+            return False
+        if now is None:
+            now = time.perf_counter()
+        if now < self.next_update:
+            return False
+        self.next_update = now + self.interval
+        if self.profiler is not None:
+            if not self.shown:
+                self.surface.blit(self.font.render('hot addresses', False, self.color), self.origin)
+                self.shown['heatmap'] = True
+            self.draw_heatmap()
+            return True
+        if not self.shown:
+            self.draw_labels()
+
+        drawn = False
+        for name, value in self.values(cpu).items():
+            if self.shown.get(name) != value:
+                self.shown[name] = value
+                pos, width, _ = self.fields[name]
+                self.draw(pos, width, value)
+                drawn = True
+        return drawn
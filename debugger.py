@@ -0,0 +1,248 @@
+from collections import namedtuple
+
+from cpu import CPU
+from disasm import mnemonic
+
+# Why the CPU stopped: kind is 'break', 'read', 'write' or 'condition', pc
+# the instruction's address and address the memory address touched
+Hit = namedtuple('Hit', 'kind pc address')
+
+# Handlers that access memory at I, and how many bytes for operand x
+STORES = {'_F033': lambda x: 3, '_F055': lambda x: x + 1}
+LOADS = {'_F065': lambda x: x + 1}
+
+
+class Debugger:
+    # PC breakpoints, memory watchpoints and break conditions.
+    #
+    # While anything is set the debugger decodes for the CPU, on top of
+    # whatever decoded before it, a tracer or profiler included. Only the
+    # opcodes that need checking are wrapped: the ones found at breakpoint
+    # addresses and the Fx33, Fx55 and Fx65 memory accesses. Everything
+    # else runs as before. Over the CPU's own table the wrapping is done
+    # once into a table of its own, so the CPU keeps its speed. Break
+    # conditions that do not belong to a breakpoint have to be checked
+    # after every instruction, they alone slow the CPU down. With nothing
+    # set the CPU gets back what it decoded with before.
+    #
+    # Conditions are Python expressions over V0-VF, V, I, pc, DT, ST,
+    # memory, stack and frames. The CPU only counts its cycles once a
+    # frame, so they are left out.
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # address -> compiled condition or None
+        self.breakpoints = {}
+        self.reads = {}
+        self.writes = {}
+        # compiled conditions checked after every instruction
+        self.conditions = []
+        # opcodes at breakpoint addresses
+        self.stops = set()
+        # decoding before the debugger's, None while not armed
+        self.previous = None
+        # the CPU's table with the checks wrapped in, updated in place so
+        # anything decoding through it sees the changes
+        self.table = []
+        # the CPU's table with the memory accesses wrapped, built once
+        self.base = None
+        # breakpoint to run past once, after stopping on it
+        self.skip = None
+        self.hit = None
+        # a new ROM or a restored snapshot changes the code at breakpoints
+        cpu.memoryListeners.append(self.reload)
+
+    def add_breakpoint(self, pc, condition=None):
+        self.breakpoints[pc & 0xfff] = self.compile(condition)
+        self.arm()
+
+    def remove_breakpoint(self, pc):
+        self.breakpoints.pop(pc & 0xfff, None)
+        self.arm()
+
+    def watch(self, address, length=1, read=False, write=True, condition=None):
+        # Stop after an instruction reads or writes memory in [address, address + length)
+        condition = self.compile(condition)
+        for addr in range(address, address + length):
+            if read:
+                self.reads[addr & 0xfff] = condition
+            if write:
+                self.writes[addr & 0xfff] = condition
+        self.arm()
+
+    def unwatch(self, address, length=1):
+        for addr in range(address, address + length):
+            self.reads.pop(addr & 0xfff, None)
+            self.writes.pop(addr & 0xfff, None)
+        self.arm()
+
+    def break_when(self, condition):
+        # Stop after the instruction that makes condition true
+        self.conditions.append(self.compile(condition))
+        self.arm()
+
+    def clear(self):
+        self.breakpoints.clear()
+        self.reads.clear()
+        self.writes.clear()
+        self.conditions.clear()
+        self.arm()
+
+    @property
+    def armed(self):
+        return bool(self.breakpoints or self.reads or self.writes or self.conditions)
+
+    @property
+    def decoder(self):
+        # What the CPU decodes with while armed
+        return self.table if self.previous is CPU.table else self
+
+    def compile(self, condition):
+        if condition is None:
+            return None
+        return compile(condition, '<condition>', 'eval')
+
+    def reload(self):
+        if self.breakpoints:
+            self.arm()
+
+    def arm(self):
+        # Decode through the checks, or as before when nothing is set
+        cpu = self.cpu
+        memory = cpu.memory
+        installed = self.previous is not None
+        on_top = installed and cpu.decoded is self.decoder
+        if not self.armed:
+            if on_top:
+                cpu.decoded = self.previous
+                self.previous = None
+            elif installed:
+                # decoded through from above, pass everything on
+                self.stops = set()
+                self.table[:] = CPU.table
+            return
+        if not installed:
+            self.previous = cpu.decoded
+        self.stops = {(memory[pc] << 8) | memory[(pc + 1) & 0xfff] for pc in self.breakpoints}
+        if self.previous is CPU.table:
+            if self.base is None:
+                self.base = [self.wrap_memory(op, entry) for op, entry in enumerate(CPU.table)]
+            table = list(self.base)
+            # only the opcodes at breakpoints are checked, once each
+            for op in self.stops:
+                table[op] = (self.check, (table[op],))
+            if self.conditions:
+                table = [(self.every, (entry,)) for entry in table]
+            self.table[:] = table
+        if not installed:
+            cpu.decoded = self.decoder
+
+    def wrap_memory(self, op, entry):
+        # entry with its memory accesses checked
+        handler, operands = CPU.table[op]
+        name = handler.__name__
+        if name in STORES:
+            # stores are checked even without watchpoints, they can change
+            # the code at a breakpoint
+            return self.store, (entry, STORES[name](*operands))
+        if name in LOADS:
+            return self.load, (entry, LOADS[name](*operands))
+        return entry
+
+    def __getitem__(self, op):
+        # Decoding on top of another decoder, a tracer or profiler
+        entry = self.previous[op]
+        if not self.armed:
+            return entry
+        entry = self.wrap_memory(op, entry)
+        if op in self.stops:
+            entry = (self.check, (entry,))
+        if self.conditions:
+            entry = (self.every, (entry,))
+        return entry
+
+    def test(self, condition):
+        if condition is None:
+            return True
+        cpu = self.cpu
+        scope = {'V%X' % i: v for i, v in enumerate(cpu.register)}
+        scope.update(V=cpu.register, I=cpu.I, pc=cpu.pc, DT=cpu.delayTimer, ST=cpu.soundTimer,
+                     memory=cpu.memory, stack=cpu.stack, frames=cpu.frames)
+        return bool(eval(condition, {}, scope))
+
+    def stop(self, kind, pc, address=None):
+        self.hit = Hit(kind, pc, address)
+        self.cpu.stop()
+
+    # Instrumented handlers, called in place of the CPU's with the entry
+    # they stand in for
+
+    def check(self, cpu, entry):
+        pc = cpu.pc - 2
+        if pc in self.breakpoints and pc != self.skip and self.test(self.breakpoints[pc]):
+            # stop before the instruction, it has not executed
+            cpu.pc = pc
+            cpu.cycles -= 1
+            self.skip = pc
+            self.stop('break', pc)
+            return
+        self.skip = None
+        handler, operands = entry
+        handler(cpu, *operands)
+
+    def store(self, cpu, entry, count):
+        handler, operands = entry
+        handler(cpu, *operands)
+        for i in range(count):
+            addr = (cpu.I + i) & 0xfff
+            if addr in self.breakpoints or (addr - 1) & 0xfff in self.breakpoints:
+                # the opcode at a breakpoint changed, either of its bytes
+                self.arm()
+            if addr in self.writes and self.test(self.writes[addr]):
+                self.stop('write', cpu.pc - 2, addr)
+                return
+
+    def load(self, cpu, entry, count):
+        handler, operands = entry
+        handler(cpu, *operands)
+        for i in range(count):
+            addr = (cpu.I + i) & 0xfff
+            if addr in self.reads and self.test(self.reads[addr]):
+                self.stop('read', cpu.pc - 2, addr)
+                return
+
+    def every(self, cpu, entry):
+        handler, operands = entry
+        pc = cpu.pc - 2
+        handler(cpu, *operands)
+        if cpu.running:
+            for condition in self.conditions:
+                if self.test(condition):
+                    self.stop('condition', pc)
+                    return
+
+    # Running
+
+    def resume(self, cycles=None):
+        # Run on from a hit, past the breakpoint it stopped on.
+        # Returns the hit that stopped it, None when cycles ran out.
+        if self.skip != self.cpu.pc:
+            # moved away from the breakpoint
+            self.skip = None
+        self.hit = None
+        self.cpu.run(cycles)
+        return self.hit
+
+    def step(self):
+        return self.resume(1)
+
+    def describe(self):
+        if self.hit is None:
+            return "running"
+        memory = self.cpu.memory
+        kind, pc, address = self.hit
+        op = (memory[pc] << 8) | memory[(pc + 1) & 0xfff]
+        text = "%s at %03X  %04X  %s" % (kind, pc, op, mnemonic(op))
+        if address is not None:
+            text += "  [%03X] = %02X" % (address, memory[address])
+        return text
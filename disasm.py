@@ -0,0 +1,255 @@
+import argparse
+import hashlib
+import os
+
+import cache
+from cache import CACHE_DIR
+from cpu import CPU
+
+# Bumped whenever the analysis changes, older cache entries are ignored
+VERSION = 1
+
+# Mnemonics for every handler, formatted with the opcode's fields
+MNEMONICS = {
+    '_00e0': 'CLS',
+    '_00ee': 'RET',
+    '_1000': 'JP {nnn:03X}',
+    '_2000': 'CALL {nnn:03X}',
+    '_3000': 'SE V{x:X}, {kk:02X}',
+    '_4000': 'SNE V{x:X}, {kk:02X}',
+    '_5000': 'SE V{x:X}, V{y:X}',
+    '_6000': 'LD V{x:X}, {kk:02X}',
+    '_7000': 'ADD V{x:X}, {kk:02X}',
+    '_8FF0': 'LD V{x:X}, V{y:X}',
+    '_8FF1': 'OR V{x:X}, V{y:X}',
+    '_8FF2': 'AND V{x:X}, V{y:X}',
+    '_8FF3': 'XOR V{x:X}, V{y:X}',
+    '_8FF4': 'ADD V{x:X}, V{y:X}',
+    '_8FF5': 'SUB V{x:X}, V{y:X}',
+    '_8FF6': 'SHR V{x:X}',
+    '_8FF7': 'SUBN V{x:X}, V{y:X}',
+    '_8FFE': 'SHL V{x:X}',
+    '_A000': 'LD I, {nnn:03X}',
+    '_C000': 'RND V{x:X}, {kk:02X}',
+    '_D000': 'DRW V{x:X}, V{y:X}, {n:X}',
+    '_E0A1': 'SKNP V{x:X}',
+    '_F007': 'LD V{x:X}, DT',
+    '_F00A': 'LD V{x:X}, K',
+    '_F015': 'LD DT, V{x:X}',
+    '_F018': 'LD ST, V{x:X}',
+    '_F01E': 'ADD I, V{x:X}',
+    '_F029': 'LD F, V{x:X}',
+    '_F033': 'LD B, V{x:X}',
+    '_F055': 'LD [I], V{x:X}',
+    '_F065': 'LD V{x:X}, [I]',
+}
+
+SKIPS = ('_3000', '_4000', '_5000', '_E0A1')
+
+
+def fields(op):
+    return {
+        'op': op,
+        'x': (op & 0x0f00) >> 8,
+        'y': (op & 0x00f0) >> 4,
+        'n': op & 0x000f,
+        'kk': op & 0x00ff,
+        'nnn': op & 0x0fff,
+    }
+
+
+def handler_name(op):
+    if CPU.table is None:
+        CPU.table = CPU.decode()
+    return CPU.table[op][0].__name__
+
+
+def mnemonic(op):
+    name = handler_name(op)
+    if name in MNEMONICS:
+        return MNEMONICS[name].format(**fields(op))
+    if op & 0xf000 == 0xb000:
+        return 'JP V0, %03X' % (op & 0x0fff)
+    # the CPU traps on it
+    return 'DW %04X' % op
+
+
+def successors(op, pc):
+    # Addresses execution can continue at after the instruction at pc,
+    # None for a target only known at run time
+    name = handler_name(op)
+    if name == '_1000':
+        return [op & 0x0fff]
+    if name == '_2000':
+        return [op & 0x0fff, pc + 2]
+    if name == '_00ee':
+        return []
+    if name in SKIPS:
+        return [pc + 2, pc + 4]
+    if name == '_trap':
+        # Bnnn jumps relative to V0, anything else stops the CPU
+        return [None] if op & 0xf000 == 0xb000 else []
+    return [pc + 2]
+
+
+class Analysis:
+    # Control-flow graph of a ROM found by following every path from the
+    # entry point. Addresses outside the reached code are data.
+
+    def __init__(self, origin, size):
+        self.origin = origin
+        self.size = size
+        # instruction address -> opcode
+        self.code = {}
+        # instruction address -> successor addresses, None when unknown
+        self.edges = {}
+        # subroutine entry points
+        self.calls = set()
+        # addresses of jumps whose target is only known at run time
+        self.unknown = set()
+        # addresses loaded into I, usually sprites
+        self.references = set()
+
+    def leaders(self):
+        # Basic block start addresses: the entry point, branch targets and
+        # the instructions after a branch
+        leaders = {self.origin}
+        for pc, targets in self.edges.items():
+            if targets != [pc + 2]:
+                leaders.update(t for t in targets if t is not None and t in self.code)
+        return sorted(leaders)
+
+    def blocks(self):
+        # start -> address after the block's last instruction
+        leaders = set(self.leaders())
+        blocks = {}
+        for start in sorted(leaders):
+            pc = start
+            while pc in self.code:
+                targets = self.edges[pc]
+                pc += 2
+                if targets != [pc] or pc in leaders:
+                    break
+            blocks[start] = pc
+        return blocks
+
+    def regions(self):
+        # (start, end, kind) covering the ROM, kind is 'code' or 'data'
+        covered = bytearray(self.size)
+        for pc in self.code:
+            for addr in (pc, pc + 1):
+                if 0 <= addr - self.origin < self.size:
+                    covered[addr - self.origin] = 1
+        regions = []
+        start = 0
+        for i in range(1, self.size + 1):
+            if i == self.size or covered[i] != covered[start]:
+                kind = 'code' if covered[start] else 'data'
+                regions.append((self.origin + start, self.origin + i, kind))
+                start = i
+        return regions
+
+    def listing(self, memory):
+        # Disassembly, code as instructions and data as bytes
+        labels = set(self.leaders()) | self.calls
+        lines = []
+        for start, end, kind in self.regions():
+            if kind == 'code':
+                pc = start
+                while pc < end:
+                    if pc not in self.code:
+                        # an odd address, inside an instruction
+                        pc += 1
+                        continue
+                    op = self.code[pc]
+                    label = ('sub_' if pc in self.calls else 'L') + '%03X:' % pc if pc in labels else ''
+                    lines.append("%-8s %03X  %04X  %s" % (label, pc, op, mnemonic(op)))
+                    pc += 2
+            else:
+                for pc in range(start, end, 8):
+                    data = memory[pc:min(pc + 8, end)]
+                    lines.append("%-8s %03X  DB %s" % ('', pc, ", ".join("%02X" % b for b in data)))
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            'version': VERSION,
+            'origin': self.origin,
+            'size': self.size,
+            'code': {'%X' % pc: op for pc, op in self.code.items()},
+            'edges': {'%X' % pc: targets for pc, targets in self.edges.items()},
+            'calls': sorted(self.calls),
+            'unknown': sorted(self.unknown),
+            'references': sorted(self.references),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        analysis = cls(data['origin'], data['size'])
+        analysis.code = {int(pc, 16): op for pc, op in data['code'].items()}
+        analysis.edges = {int(pc, 16): targets for pc, targets in data['edges'].items()}
+        analysis.calls = set(data['calls'])
+        analysis.unknown = set(data['unknown'])
+        analysis.references = set(data['references'])
+        return analysis
+
+
+def analyze(romdata, origin=0x200):
+    # Recursive descent from the entry point over the ROM loaded at origin
+    memory = bytearray(4096)
+    memory[origin:origin + len(romdata)] = romdata
+    analysis = Analysis(origin, len(romdata))
+    pending = [origin]
+    while pending:
+        pc = pending.pop()
+        if pc in analysis.code or not origin <= pc < 4095:
+            continue
+        op = (memory[pc] << 8) | memory[pc + 1]
+        analysis.code[pc] = op
+        targets = successors(op, pc)
+        analysis.edges[pc] = targets
+        name = handler_name(op)
+        if name == '_2000':
+            analysis.calls.add(op & 0x0fff)
+        elif name == '_A000':
+            analysis.references.add(op & 0x0fff)
+        if None in targets:
+            analysis.unknown.add(pc)
+        pending.extend(t for t in targets if t is not None)
+    return analysis
+
+
+def rom_hash(romdata):
+    return hashlib.sha1(romdata).hexdigest()
+
+
+def load(rom, cache_dir=CACHE_DIR):
+    # Analysis of the ROM file, from the cache when it has been seen before
+    romdata = open(rom, 'rb').read()
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, rom_hash(romdata) + '.json')
+        data = cache.read(path)
+        if data is not None and data.get('version') == VERSION:
+            return Analysis.from_dict(data)
+    analysis = analyze(romdata)
+    if path is not None:
+        cache.write(path, analysis.to_dict())
+    return analysis
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Disassemble a chip-8 ROM")
+    parser.add_argument('rom')
+    parser.add_argument('--no-cache', action='store_true', help="analyze without reading or writing the cache")
+    args = parser.parse_args()
+
+    analysis = load(args.rom, None if args.no_cache else CACHE_DIR)
+    memory = bytearray(4096)
+    romdata = open(args.rom, 'rb').read()
+    memory[analysis.origin:analysis.origin + len(romdata)] = romdata
+    print(analysis.listing(memory))
+
+
+if __name__ == "__main__":
+    main()
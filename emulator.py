@@ -0,0 +1,218 @@
+import logging
+import os
+import time
+
+import pygame
+
+import cache
+from audio import open_audio
+from cpu import *
+from debug_panel import DebugPanel
+from profiler import Profiler
+from replay import Recorder, save
+from translator import Translator
+
+KEY_MAP = {
+    pygame.K_1: 0x1,
+    pygame.K_2: 0x2,
+    pygame.K_3: 0x3,
+    pygame.K_4: 0xc,
+    pygame.K_q: 0x4,
+    pygame.K_w: 0x5,
+    pygame.K_e: 0x6,
+    pygame.K_r: 0xd,
+    pygame.K_a: 0x7,
+    pygame.K_s: 0x8,
+    pygame.K_d: 0x9,
+    pygame.K_f: 0xe,
+    pygame.K_z: 0xa,
+    pygame.K_x: 0,
+    pygame.K_c: 0xb,
+    pygame.K_v: 0xf
+}
+
+# Palette indices for the 8 pixels of every sprite byte
+ROW_PIXELS = [bytes((b >> (7 - i)) & 1 for i in range(8)) for b in range(256)]
+
+# Font name -> file found for it, None when not installed
+FONT_CACHE = os.path.join(cache.CACHE_DIR, 'fonts.json')
+
+
+def load_font(name, size):
+    # Looking up a system font scans every installed font, so the file found
+    # is cached. Fonts that are not installed fall back to pygame's own.
+    fonts = cache.read(FONT_CACHE) or {}
+    if name in fonts:
+        try:
+            return pygame.font.Font(fonts[name], size)
+        except OSError:
+            # removed since, look it up again
+            pass
+    fonts[name] = pygame.font.match_font(name)
+    cache.write(FONT_CACHE, fonts)
+    return pygame.font.Font(fonts[name], size)
+
+
+class Emulator:
+    def __init__(self, rom, record=None, scale=10, debug=True, ipf=10, seed=None, started=None, sound=True,
+                 speed=1):
+        self._running = False
+        self.scaleFactor = scale
+        self._display_surf = None
+        self.screen = None
+        self.scaled = None
+        self.shown = None
+        self.font = None
+        # created when first shown
+        self.debug = None
+        self.showDebug = debug
+        self.fontName = 'Hack Regular'
+        # opened on the first sound
+        self.audio = None
+        self.sound = sound
+        self.rom = rom
+        self.debugWidth = 30
+        self.debugRefresh = 10  # Hz
+        # Last frame presented, and the longest wait for the next one
+        self.sequence = 0
+        self.frameTimeout = 1 / 60
+        # CPU sound count at the last frame presented
+        self.sounds = 0
+        # When the launcher started, to time the first frame
+        self.started = started
+        self.cpu = CPU(seed)
+        self.cpu.ipf = ipf
+        # multiple of real time, None runs as fast as possible
+        self.speed = speed
+        self.profiler = Profiler(self.cpu)
+        # runs the CPU's frames, on its own path while profiling
+        self.translator = Translator(self.cpu)
+        # Keys reach the CPU through the recorder, which saves them to record if given
+        self.recorder = Recorder(self.cpu)
+        self.record = record
+        self.background_color = (0, 0, 0)
+        self.foreground_color = (255, 255, 255)
+        self.size = self.width, self.height = 64 * self.scaleFactor, 32 * self.scaleFactor
+        self.sizeWithDebug = self.size[0] + self.debugWidth * self.scaleFactor, self.size[1]
+
+    def on_init(self):
+        # Only the display is needed for the first frame, fonts and sound
+        # are set up when first used
+        pygame.display.init()
+        pygame.display.set_caption("chip-8 emulator")
+        self._display_surf = pygame.display.set_mode(self.sizeWithDebug, pygame.HWSURFACE | pygame.DOUBLEBUF)
+        self._display_surf.fill(self.background_color)
+        # Palette indexed surfaces reused for every frame
+        self.screen = pygame.Surface((64, 32), depth=8)
+        self.screen.set_palette([self.background_color, self.foreground_color])
+        self.scaled = pygame.Surface(self.size, depth=8)
+        self.scaled.set_palette([self.background_color, self.foreground_color])
+        self.shown = array('Q', BLANK)
+        self.blit_screen()
+        if self.showDebug:
+            self.debug_panel()
+        self.translator.load(self.rom)
+        self.cpu.start(self.recorder, self.translator, self.speed)
+        self._running = True
+        self.on_render()
+
+    def debug_panel(self):
+        if self.debug is None:
+            pygame.font.init()
+            self.font = load_font(self.fontName, 2 * self.scaleFactor)
+            self.debug = DebugPanel(self._display_surf, self.font, (self.width, 0),
+                                    (self.debugWidth * self.scaleFactor, self.height),
+                                    self.scaleFactor, self.debugRefresh)
+            self.debug.clear()
+        return self.debug
+
+    def on_event(self, event):
+        if event.type == pygame.QUIT:
+            self._running = False
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_F1:
+                if self.debug is None:
+                    self.debug_panel()
+                else:
+                    self.debug.toggle()
+                self.on_render()
+            if event.key == pygame.K_F2:
+                # profile while the heatmap is shown
+                if self.profiler.enabled:
+                    self.profiler.disable()
+                    self.debug_panel().show_heatmap(None)
+                else:
+                    self.profiler.clear()
+                    self.profiler.enable()
+                    self.debug_panel().show_heatmap(self.profiler)
+            if event.key in KEY_MAP.keys():
+                self.recorder.key_down(KEY_MAP[event.key])
+        if event.type == pygame.KEYUP:
+            if event.key in KEY_MAP.keys():
+                self.recorder.key_up(KEY_MAP[event.key])
+
+    def on_loop(self):
+        dirty = False
+        # Sleep until the CPU publishes a frame, waking up often enough for input
+        frame = self.cpu.wait_frame(self.sequence, self.frameTimeout)
+        if frame is not None:
+            self.sequence, rows = frame
+            dirty = self.update_screen(memoryview(rows).cast('Q'))
+        # The tone plays while the sound timer runs, and for a beep that
+        # started and ran out since the last look
+        sounds = self.cpu.sounds
+        sounding = self.cpu.soundTimer > 0 or sounds != self.sounds
+        self.sounds = sounds
+        if sounding and self.audio is None:
+            self.audio = open_audio(self.sound)
+        if self.audio is not None:
+            self.audio.update(sounding)
+        if self.debug is not None and self.debug.update(self.cpu):
+            dirty = True
+        if dirty:
+            self.on_render()
+
+    def update_screen(self, rows):
+        # Write the rows that changed since the last frame into the screen surface
+        dirty = False
+        pitch = self.screen.get_pitch()
+        pixels = self.screen.get_buffer()
+        for y, row in enumerate(rows):
+            if row != self.shown[y]:
+                self.shown[y] = row
+                pixels.write(b''.join([ROW_PIXELS[b] for b in row.to_bytes(8, 'big')]), y * pitch)
+                dirty = True
+        # release the surface lock
+        del pixels
+        if dirty:
+            self.blit_screen()
+        return dirty
+
+    def blit_screen(self):
+        pygame.transform.scale(self.screen, self.size, self.scaled)
+        self._display_surf.blit(self.scaled, (0, 0))
+
+    def on_render(self):
+        pygame.display.flip()
+        if self.started is not None:
+            logging.info("First frame %.3fs after starting", time.perf_counter() - self.started)
+            self.started = None
+
+    def on_cleanup(self):
+        if self.audio is not None:
+            self.audio.close()
+        pygame.quit()
+        self.cpu.stop()
+        if self.record is not None:
+            save(self.record, self.recorder.recording(open(self.rom, 'rb').read()))
+
+    def on_execute(self):
+        if not self._running:
+            self.on_init()
+            self._running = True
+
+        while (self._running):
+            for event in pygame.event.get():
+                self.on_event(event)
+            self.on_loop()
+        self.on_cleanup()
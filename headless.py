@@ -0,0 +1,115 @@
+import argparse
+import logging
+import time
+
+import replay
+from capture import Capture
+from cpu import CPU
+from debugger import Debugger
+from profiler import Profiler
+from tracer import Tracer
+from translator import Translator
+
+
+def dump(cpu, executed, elapsed):
+    lines = []
+    lines.append("cycles: %d   frames: %d   time: %.3fs" % (executed, cpu.frames, elapsed))
+    lines.append("PC: %X   I: %X   Delay: %X   Sound: %X" % (cpu.pc, cpu.I, cpu.delayTimer, cpu.soundTimer))
+    lines.append("registers: " + " ".join("V%X: %02X" % (i, v) for i, v in enumerate(cpu.register)))
+    lines.append("stack: " + " ".join("%X" % x for x in cpu.stack))
+    if cpu.trap is not None:
+        lines.append("trap: %04X" % cpu.trap)
+    lines.append("framebuffer:")
+    for row in cpu.frame_view():
+        lines.append(format(row, '064b').replace('0', '.').replace('1', '#'))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a chip-8 ROM without a display")
+    parser.add_argument('rom')
+    parser.add_argument('--cycles', type=int, default=100000, help="instructions to execute")
+    parser.add_argument('--until-pc', type=lambda v: int(v, 16), default=None, help="stop when pc reaches this address (hex)")
+    parser.add_argument('--max-time', type=float, default=None, help="stop after this many seconds")
+    parser.add_argument('--ipf', type=int, default=10, help="instructions per 60 Hz timer frame")
+    parser.add_argument('--interpret', action='store_true', help="run every instruction on the interpreter, without compiling blocks")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    parser.add_argument('--replay', metavar='FILE', help="press keys from an input recording, at full speed")
+    parser.add_argument('--capture', metavar='FILE', help="write every frame to a capture file")
+    parser.add_argument('--break', dest='breakpoints', type=lambda v: int(v, 16), action='append', default=[],
+                        metavar='ADDR', help="stop before the instruction at this address (hex), repeatable")
+    parser.add_argument('--watch', type=lambda v: int(v, 16), action='append', default=[],
+                        metavar='ADDR', help="stop after a write to this address (hex), repeatable")
+    parser.add_argument('--watch-read', type=lambda v: int(v, 16), action='append', default=[],
+                        metavar='ADDR', help="stop after a read from this address (hex), repeatable")
+    parser.add_argument('--break-if', action='append', default=[], metavar='EXPR',
+                        help="stop after the instruction that makes a Python expression over V0-VF, I, pc, DT, ST true")
+    parser.add_argument('--trace', type=int, default=0, metavar='N', help="print the last N instructions on a trap")
+    parser.add_argument('--profile', metavar='FILE', help="write an opcode and address profile as JSON")
+    parser.add_argument('--flamegraph', metavar='FILE', help="write a profile as collapsed stacks for flamegraph tools")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    recording = None
+    if args.replay:
+        recording = replay.load(args.replay)
+        if recording.rom != replay.rom_hash(open(args.rom, 'rb').read()):
+            logging.warning("%s was recorded with a different ROM", args.replay)
+        cpu = CPU(recording.seed)
+        cpu.ipf = recording.ipf
+    else:
+        cpu = CPU(args.seed)
+        cpu.ipf = args.ipf
+    # tracing, profiling and debugging keep to the interpreter on their own
+    translator = None if args.interpret else Translator(cpu)
+    if translator is not None:
+        translator.load(args.rom)
+    else:
+        cpu.load_rom(args.rom)
+    tracer = None
+    if args.trace:
+        tracer = Tracer(cpu, args.trace)
+        tracer.enable()
+    profiler = None
+    if args.profile or args.flamegraph:
+        profiler = Profiler(cpu)
+        profiler.enable()
+    debugger = None
+    if args.breakpoints or args.watch or args.watch_read or args.break_if:
+        debugger = Debugger(cpu)
+        for address in args.breakpoints:
+            debugger.add_breakpoint(address)
+        for address in args.watch:
+            debugger.watch(address)
+        for address in args.watch_read:
+            debugger.watch(address, read=True, write=False)
+        for condition in args.break_if:
+            debugger.break_when(condition)
+    capture = None
+    if args.capture:
+        capture = Capture(cpu, args.capture)
+    start = time.perf_counter()
+    if recording is not None:
+        executed = replay.drive(cpu, recording.events, args.cycles, translator, args.until_pc, args.max_time)
+    elif translator is not None:
+        executed = translator.run(cycles=args.cycles, until_pc=args.until_pc, max_time=args.max_time)
+    else:
+        executed = cpu.run(cycles=args.cycles, until_pc=args.until_pc, max_time=args.max_time)
+    if capture is not None:
+        capture.close()
+    print(dump(cpu, executed, time.perf_counter() - start))
+    if debugger is not None and debugger.hit is not None:
+        print(debugger.describe())
+    if tracer is not None and cpu.trap is not None:
+        print("trace:")
+        print(tracer.dump(decode=True))
+    if args.profile:
+        with open(args.profile, 'w') as f:
+            f.write(profiler.json())
+    if args.flamegraph:
+        with open(args.flamegraph, 'w') as f:
+            f.write(profiler.flamegraph() + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import random
+from array import array
+
+import numpy as np
+
+from cpu import CPU, ROM_SIZE
+
+# Depth of each lane's call stack
+STACK_SIZE = 64
+
+# Handler names, the index of each one is its group number
+HANDLERS = [name for name, _ in CPU.opcodes.values()] + ['_trap']
+
+
+def handler_table():
+    # opcode -> group number, built from the CPU's decode table
+    index = {name: i for i, name in enumerate(HANDLERS)}
+    return np.array([index[handler.__name__] for handler, _ in CPU.table], dtype=np.int8)
+
+
+class Lockstep:
+    # Runs many machines in lockstep, one instruction for every lane at a
+    # time. Lanes are grouped by decoded opcode and every group executes as
+    # numpy array operations, giving the same results as CPU.cycle per lane.
+    # Timers tick every ipf instructions, as CPU.run does, without its idle
+    # skipping. Cxkk draws from a random.Random per lane, the same numbers
+    # as a CPU with that lane's seed. A lane that overflows its STACK_SIZE
+    # deep stack traps.
+
+    table = None
+
+    def __init__(self, lanes, ipf=10, seeds=None):
+        if CPU.table is None:
+            CPU.table = CPU.decode()
+        if Lockstep.table is None:
+            Lockstep.table = handler_table()
+        self.lanes = lanes
+        self.ipf = ipf
+        self.memory = np.zeros((lanes, 4096), dtype=np.uint8)
+        self.register = np.zeros((lanes, 16), dtype=np.uint8)
+        self.I = np.zeros(lanes, dtype=np.int64)
+        self.pc = np.zeros(lanes, dtype=np.int64)
+        self.stack = np.zeros((lanes, STACK_SIZE), dtype=np.int64)
+        self.sp = np.zeros(lanes, dtype=np.int64)
+        self.delayTimer = np.zeros(lanes, dtype=np.int64)
+        self.soundTimer = np.zeros(lanes, dtype=np.int64)
+        self.frameBuffer = np.zeros((lanes, 32), dtype=np.uint64)
+        self.input = np.zeros((lanes, 16), dtype=np.uint8)
+        self.control = np.zeros((lanes, 16), dtype=np.uint8)
+        self.waitKey = np.zeros(lanes, dtype=bool)
+        self.running = np.ones(lanes, dtype=bool)
+        self.trap = np.full(lanes, -1, dtype=np.int64)
+        self.cycles = 0
+        self.frames = 0
+        if seeds is None:
+            seeds = range(lanes)
+        self.seeds = list(seeds)
+        self.rng = [random.Random(seed) for seed in self.seeds]
+        self.groups = [getattr(self, name) for name in HANDLERS]
+        self.reset()
+
+    def reset(self):
+        self.memory[:] = 0
+        self.memory[:, :len(CPU.font)] = CPU.font
+        self.register[:] = 0
+        self.I[:] = 0
+        self.pc[:] = 0x200
+        self.sp[:] = 0
+        self.delayTimer[:] = 0
+        self.soundTimer[:] = 0
+        self.frameBuffer[:] = 0
+        self.input[:] = 0
+        self.control[:] = 0
+        self.waitKey[:] = False
+        self.running[:] = True
+        self.trap[:] = -1
+        self.cycles = 0
+        self.frames = 0
+        for rng, seed in zip(self.rng, self.seeds):
+            rng.seed(seed)
+
+    def load_rom(self, rom):
+        romdata = np.frombuffer(open(rom, 'rb').read(), dtype=np.uint8)
+        if len(romdata) > ROM_SIZE:
+            raise ValueError("ROM is %d bytes, at most %d fit in memory" % (len(romdata), ROM_SIZE))
+        self.memory[:, 0x200:0x200 + len(romdata)] = romdata
+
+    def lane(self, i):
+        # The state of lane i as a CPU
+        cpu = CPU(self.seeds[i])
+        cpu.memory[:] = self.memory[i].tobytes()
+        cpu.register[:] = self.register[i].tobytes()
+        cpu.I = int(self.I[i])
+        cpu.pc = int(self.pc[i])
+        cpu.stack.extend(int(v) for v in self.stack[i, :self.sp[i]])
+        cpu.delayTimer = int(self.delayTimer[i])
+        cpu.soundTimer = int(self.soundTimer[i])
+        cpu.frameBuffer[:] = array('Q', self.frameBuffer[i].tobytes())
+        cpu.input[:] = self.input[i].tobytes()
+        cpu.control[:] = self.control[i].tobytes()
+        cpu.waitKey = bool(self.waitKey[i])
+        cpu.trap = None if self.trap[i] < 0 else int(self.trap[i])
+        cpu.ipf = self.ipf
+        cpu.cycles = self.cycles
+        cpu.frames = self.frames
+        # carry on with the lane's random numbers, not from its seed
+        cpu.rng.setstate(self.rng[i].getstate())
+        return cpu
+
+    def step(self):
+        # Execute one instruction on every running lane
+        lanes = np.flatnonzero(self.running)
+        pc = self.pc[lanes] & 0xfff
+        op = (self.memory[lanes, pc].astype(np.int64) << 8) | self.memory[lanes, (pc + 1) & 0xfff]
+        self.pc[lanes] = (pc + 2) & 0xfff
+
+        groups = self.table[op]
+        order = np.argsort(groups, kind='stable')
+        counts = np.bincount(groups, minlength=len(HANDLERS))
+        start = 0
+        for group, count in enumerate(counts):
+            if count:
+                members = order[start:start + count]
+                self.groups[group](lanes[members], op[members])
+                start += count
+
+    def run(self, cycles):
+        for _ in range(cycles):
+            self.step()
+            self.cycles += 1
+            if not self.cycles % self.ipf:
+                self.tick_timers()
+
+    def tick_timers(self):
+        # a CPU publishes its frame and drops the flush line here
+        self.control[:, 0] = 0
+        self.delayTimer[self.delayTimer > 0] -= 1
+        sounding = self.soundTimer > 0
+        self.soundTimer[sounding] -= 1
+        self.control[sounding & (self.soundTimer == 0), 1] = 1
+        self.frames += 1
+
+    # Handlers, L holds the lanes and op their opcodes
+
+    def _trap(self, L, op):
+        self.trap[L] = op
+        self.running[L] = False
+
+    def _00e0(self, L, op):
+        self.frameBuffer[L] = 0
+        self.control[L, 0] = 1
+
+    def _00ee(self, L, op):
+        # an empty stack leaves pc past the instruction, as CPU.cycle does
+        L = L[self.sp[L] > 0]
+        self.sp[L] -= 1
+        self.pc[L] = self.stack[L, self.sp[L]]
+
+    def _1000(self, L, op):
+        self.pc[L] = op & 0x0fff
+
+    def _2000(self, L, op):
+        full = self.sp[L] >= STACK_SIZE
+        self._trap(L[full], op[full])
+        L, op = L[~full], op[~full]
+        self.stack[L, self.sp[L]] = self.pc[L]
+        self.sp[L] += 1
+        self.pc[L] = op & 0x0fff
+
+    def _3000(self, L, op):
+        self.pc[L] += 2 * (self.register[L, (op >> 8) & 0xf] == (op & 0xff))
+
+    def _4000(self, L, op):
+        self.pc[L] += 2 * (self.register[L, (op >> 8) & 0xf] != (op & 0xff))
+
+    def _5000(self, L, op):
+        self.pc[L] += 2 * (self.register[L, (op >> 8) & 0xf] == self.register[L, (op >> 4) & 0xf])
+
+    def _6000(self, L, op):
+        self.register[L, (op >> 8) & 0xf] = op & 0xff
+
+    def _7000(self, L, op):
+        x = (op >> 8) & 0xf
+        self.register[L, x] = (self.register[L, x] + (op & 0xff)) & 0xff
+
+    # 8xy_ handlers set VF before writing Vx, in the same order as the CPU,
+    # so they agree when x or y is F
+
+    def _8FF0(self, L, op):
+        self.register[L, (op >> 8) & 0xf] = self.register[L, (op >> 4) & 0xf]
+
+    def _8FF1(self, L, op):
+        x, y = (op >> 8) & 0xf, (op >> 4) & 0xf
+        self.register[L, x] |= self.register[L, y]
+
+    def _8FF2(self, L, op):
+        x, y = (op >> 8) & 0xf, (op >> 4) & 0xf
+        self.register[L, x] &= self.register[L, y]
+
+    def _8FF3(self, L, op):
+        x, y = (op >> 8) & 0xf, (op >> 4) & 0xf
+        self.register[L, x] ^= self.register[L, y]
+
+    def _8FF4(self, L, op):
+        V = self.register
+        x, y = (op >> 8) & 0xf, (op >> 4) & 0xf
+        V[L, 0xf] = V[L, x].astype(np.int64) + V[L, y] > 0xff
+        V[L, x] = (V[L, x].astype(np.int64) + V[L, y]) & 0xff
+
+    def _8FF5(self, L, op):
+        V = self.register
+        x, y = (op >> 8) & 0xf, (op >> 4) & 0xf
+        V[L, 0xf] = V[L, y] <= V[L, x]
+        V[L, x] = (V[L, x].astype(np.int64) - V[L, y]) & 0xff
+
+    def _8FF6(self, L, op):
+        V = self.register
+        x = (op >> 8) & 0xf
+        V[L, 0xf] = V[L, x] & 1
+        V[L, x] = V[L, x] >> 1
+
+    def _8FF7(self, L, op):
+        V = self.register
+        x, y = (op >> 8) & 0xf, (op >> 4) & 0xf
+        V[L, 0xf] = V[L, x] <= V[L, y]
+        V[L, x] = (V[L, y].astype(np.int64) - V[L, x]) & 0xff
+
+    def _8FFE(self, L, op):
+        V = self.register
+        x = (op >> 8) & 0xf
+        V[L, 0xf] = (V[L, x] & 0xf0) >> 7
+        V[L, x] = (V[L, x].astype(np.int64) << 1) & 0xff
+
+    def _A000(self, L, op):
+        self.I[L] = op & 0x0fff
+
+    def _C000(self, L, op):
+        x = (op >> 8) & 0xf
+        values = [self.rng[lane].getrandbits(8) for lane in L]
+        self.register[L, x] = np.array(values, dtype=np.int64) & op & 0xff
+
+    def _D000(self, L, op):
+        V = self.register
+        x = V[L, (op >> 8) & 0xf].astype(np.uint64)
+        y = V[L, (op >> 4) & 0xf].astype(np.int64)
+        n = op & 0xf
+        visible = x < 64
+        # keep shifts below 64 bits, clipped sprites are masked out
+        shift = np.where(visible, x, 0).astype(np.uint64)
+        collision = np.zeros(len(L), dtype=np.uint64)
+        for row in range(int(n.max(initial=0))):
+            draw = (row < n) & (y + row < 32)
+            if not draw.any():
+                continue
+            lanes = L[draw]
+            sprite = self.memory[lanes, (self.I[lanes] + row) & 0xfff].astype(np.uint64)
+            sprite = ((sprite << np.uint64(56)) >> shift[draw]) * visible[draw]
+            rows = self.frameBuffer[lanes, y[draw] + row]
+            collision[draw] |= rows & sprite
+            self.frameBuffer[lanes, y[draw] + row] = rows ^ sprite
+        V[L, 0xf] = collision != 0
+        self.control[L, 0] = 1
+
+    def _E0A1(self, L, op):
+        # tests the key numbered x, as the CPU does
+        self.pc[L] += 2 * (self.input[L, (op >> 8) & 0xf] == 0)
+
+    def _F007(self, L, op):
+        self.register[L, (op >> 8) & 0xf] = self.delayTimer[L]
+
+    def _F00A(self, L, op):
+        x = (op >> 8) & 0xf
+        pressed = self.input[L] == 1
+        down = pressed.any(axis=1)
+        # the highest key pressed wins
+        key = 15 - np.argmax(pressed[:, ::-1], axis=1)
+        self.register[L[down], x[down]] = key[down]
+        self.pc[L[~down]] -= 2
+        self.waitKey[L] = ~down
+
+    def _F015(self, L, op):
+        self.delayTimer[L] = self.register[L, (op >> 8) & 0xf]
+
+    def _F018(self, L, op):
+        self.soundTimer[L] = self.register[L, (op >> 8) & 0xf]
+
+    def _F01E(self, L, op):
+        V = self.register
+        I = self.I[L] + V[L, (op >> 8) & 0xf]
+        V[L, 0xf] = I > 0xfff
+        self.I[L] = I & 0xfff
+
+    def _F029(self, L, op):
+        self.I[L] = (5 * self.register[L, (op >> 8) & 0xf].astype(np.int64)) & 0xfff
+
+    def _F033(self, L, op):
+        v = self.register[L, (op >> 8) & 0xf]
+        I = self.I[L]
+        self.memory[L, I] = v // 100
+        self.memory[L, (I + 1) & 0xfff] = (v // 10) % 10
+        self.memory[L, (I + 2) & 0xfff] = v % 10
+
+    def _F055(self, L, op):
+        x = (op >> 8) & 0xf
+        for i in range(int(x.max(initial=0)) + 1):
+            lanes = L[x >= i]
+            self.memory[lanes, (self.I[lanes] + i) & 0xfff] = self.register[lanes, i]
+
+    def _F065(self, L, op):
+        x = (op >> 8) & 0xf
+        for i in range(int(x.max(initial=0)) + 1):
+            lanes = L[x >= i]
+            self.register[lanes, i] = self.memory[lanes, (self.I[lanes] + i) & 0xfff]
@@ -0,0 +1,121 @@
+import json
+import math
+import time
+from array import array
+
+from cpu import CPU
+
+
+class Profiler:
+    # Counts executions per opcode and per address, and times one handler
+    # call in every sample. Like the tracer it stands in for the CPU's
+    # decode table while enabled, so a CPU that is not profiled pays nothing.
+
+    def __init__(self, cpu, sample=97):
+        self.cpu = cpu
+        self.sample = sample
+        # executions per opcode and per pc
+        self.ops = array('Q', [0]) * 0x10000
+        self.pcs = array('Q', [0]) * 0x1000
+        # handler -> [timed calls, seconds]
+        self.timings = {}
+        self.count = 0
+        self.table = CPU.table
+
+    def enable(self):
+        # decode through whatever was in place, so a tracer keeps working
+        if not self.enabled:
+            self.table = self.cpu.decoded
+            self.cpu.decoded = self
+
+    def disable(self):
+        if self.enabled:
+            self.cpu.decoded = self.table
+
+    @property
+    def enabled(self):
+        return self.cpu.decoded is self
+
+    def clear(self):
+        self.ops = array('Q', [0]) * 0x10000
+        self.pcs = array('Q', [0]) * 0x1000
+        self.timings.clear()
+        self.count = 0
+
+    def __getitem__(self, op):
+        self.ops[op] += 1
+        # pc has already moved past the instruction
+        self.pcs[(self.cpu.pc - 2) & 0xfff] += 1
+        self.count += 1
+        entry = self.table[op]
+        if self.count % self.sample:
+            return entry
+        return self.timed, entry
+
+    def timed(self, cpu, handler, operands):
+        start = time.perf_counter()
+        try:
+            handler(cpu, *operands)
+        finally:
+            timing = self.timings.setdefault(handler.__name__, [0, 0.0])
+            timing[0] += 1
+            timing[1] += time.perf_counter() - start
+
+    def opcodes(self):
+        # handler name -> executions
+        counts = {}
+        for op, n in enumerate(self.ops):
+            if n:
+                name = CPU.table[op][0].__name__
+                counts[name] = counts.get(name, 0) + n
+        return counts
+
+    def hot(self, limit=None):
+        # (pc, executions) from the most executed address down
+        pcs = sorted(((n, pc) for pc, n in enumerate(self.pcs) if n), reverse=True)
+        return [(pc, n) for n, pc in pcs[:limit]]
+
+    def mean(self, name):
+        # Sampled seconds per call of a handler, None when never sampled
+        calls, seconds = self.timings.get(name, (0, 0))
+        return seconds / calls if calls else None
+
+    def report(self, limit=64):
+        opcodes = {}
+        for name, count in sorted(self.opcodes().items(), key=lambda item: -item[1]):
+            calls, seconds = self.timings.get(name, (0, 0.0))
+            opcodes[name.lstrip('_')] = {
+                'count': count,
+                'sampled': calls,
+                'mean_ns': seconds / calls * 1e9 if calls else None,
+            }
+        return {
+            'instructions': self.count,
+            'opcodes': opcodes,
+            'hot': [{'pc': '%03X' % pc, 'count': n} for pc, n in self.hot(limit)],
+        }
+
+    def json(self, limit=64):
+        return json.dumps(self.report(limit), indent=2)
+
+    def flamegraph(self):
+        # Collapsed stacks, "handler;pc weight" per line, weighted by the
+        # estimated nanoseconds spent there. The handler is the one decoded
+        # from memory now, which differs only for self-modifying code.
+        memory = self.cpu.memory
+        lines = []
+        for pc, n in self.hot():
+            op = (memory[pc] << 8) | memory[(pc + 1) & 0xfff]
+            name = CPU.table[op][0].__name__
+            mean = self.mean(name)
+            weight = n * mean * 1e9 if mean is not None else n
+            lines.append("%s;%03X %d" % (name.lstrip('_'), pc, max(round(weight), 1)))
+        return "\n".join(lines)
+
+    def heat(self):
+        # Executions per address scaled to 0-255 on a log scale
+        top = max(self.pcs)
+        if not top:
+            return bytes(0x1000)
+        scale = 255 / math.log1p(top)
+        return bytes(int(math.log1p(n) * scale) for n in self.pcs)
@@ -0,0 +1,108 @@
+import hashlib
+import struct
+import time
+from collections import deque, namedtuple
+
+# Recording layout, little endian:
+#   header: magic, seed, instructions per frame, sha1 of the ROM, event count
+#   events: frame, then the key in the low 4 bits and pressed in bit 4
+MAGIC = b'C8R1'
+HEADER = struct.Struct('<4sIH20sI')
+EVENT = struct.Struct('<IB')
+
+# events is a sequence of (frame, key, pressed) in the order they happened
+Recording = namedtuple('Recording', 'seed ipf rom events')
+
+
+def rom_hash(romdata):
+    return hashlib.sha1(romdata).digest()
+
+
+def save(path, recording):
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, recording.seed, recording.ipf, recording.rom, len(recording.events)))
+        f.write(b''.join(EVENT.pack(frame, key | pressed << 4) for frame, key, pressed in recording.events))
+
+
+def load(path):
+    data = open(path, 'rb').read()
+    magic, seed, ipf, rom, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a chip-8 input recording")
+    events = tuple((frame, value & 0xf, value >> 4)
+                   for frame, value in EVENT.iter_unpack(data[HEADER.size:HEADER.size + count * EVENT.size]))
+    return Recording(seed, ipf, rom, events)
+
+
+class Recorder:
+    # Passes key transitions to a CPU at frame boundaries and records the
+    # frame each one took effect in. Keys pressed while a frame runs wait for
+    # the next one, so replaying the recording gives the same run.
+    # The CPU's clock calls apply() before every frame.
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.pending = deque()
+        self.events = []
+
+    def key_down(self, key):
+        self.pending.append((key, 1))
+        # wake a CPU waiting for a key
+        self.cpu.keyEvent.set()
+
+    def key_up(self, key):
+        self.pending.append((key, 0))
+
+    def apply(self):
+        cpu = self.cpu
+        while self.pending:
+            key, pressed = self.pending.popleft()
+            if pressed:
+                cpu.key_down(key)
+            else:
+                cpu.key_up(key)
+            self.events.append((cpu.frames, key, pressed))
+
+    def recording(self, romdata):
+        return Recording(self.cpu.seed, self.cpu.ipf, rom_hash(romdata), tuple(self.events))
+
+
+def drive(cpu, events, cycles, translator=None, until_pc=None, max_time=None):
+    # Run cpu for cycles instructions as fast as possible, pressing and
+    # releasing keys at the start of the frame of each (frame, key, pressed)
+    # event. Time spent blocked on a key is skipped. Stops early when pc
+    # reaches until_pc or after max_time seconds, as CPU.run does. Returns
+    # the instructions executed, counting skipped ones. Runs from
+    # translator's compiled blocks when given.
+    run = cpu.run if translator is None else translator.run
+    if max_time is not None:
+        deadline = time.perf_counter() + max_time
+    events = sorted(events, key=lambda event: event[0])
+    executed = 0
+    i = 0
+    while executed < cycles and cpu.trap is None:
+        while i < len(events) and events[i][0] <= cpu.frames:
+            frame, key, pressed = events[i]
+            if pressed:
+                cpu.key_down(key)
+            else:
+                cpu.key_up(key)
+            i += 1
+        budget = cycles - executed
+        if i < len(events):
+            # run up to the frame of the next event
+            budget = min(budget, events[i][0] * cpu.ipf - cpu.cycles)
+        n = run(budget, until_pc, None if max_time is None else deadline - time.perf_counter())
+        executed += n
+        if not cpu.running or cpu.pc == until_pc:
+            # stopped by a trap or a debugger, or reached until_pc
+            break
+        if max_time is not None and time.perf_counter() >= deadline:
+            break
+        if n < budget and cpu.blocked():
+            if i == len(events):
+                break
+            # nothing happens until the next key event
+            cpu.fast_forward(budget - n)
+            executed += budget - n
+    return executed
@@ -0,0 +1,158 @@
+import re
+import struct
+from array import array
+from collections import deque
+
+# Snapshot layout, little endian:
+#   header: magic, I, pc, delay timer, sound timer, cycles, frames,
+#           waiting for a key, stack depth
+#   memory (4096), registers (16), input (16), control lines (16),
+#   framebuffer (32 rows of 8 bytes), random number generator state
+#   (625 words), stack (2 bytes per entry)
+MAGIC = b'C8S2'
+HEADER = struct.Struct('<4sHHBBQQ?H')
+MEMORY = HEADER.size
+REGISTERS = MEMORY + 4096
+INPUT = REGISTERS + 16
+CONTROL = INPUT + 16
+FRAMEBUFFER = CONTROL + 16
+RNG = FRAMEBUFFER + 32 * 8
+STACK = RNG + 625 * 4
+
+
+def save(cpu):
+    return b''.join((
+        HEADER.pack(MAGIC, cpu.I, cpu.pc, cpu.delayTimer, cpu.soundTimer, cpu.cycles, cpu.frames,
+                    cpu.waitKey, len(cpu.stack)),
+        cpu.memory,
+        cpu.register,
+        cpu.input,
+        cpu.control,
+        cpu.frameBuffer.tobytes(),
+        array('I', cpu.rng.getstate()[1]).tobytes(),
+        array('H', cpu.stack).tobytes(),
+    ))
+
+
+def restore(cpu, data):
+    # Load a snapshot into cpu, reusing its buffers
+    magic, I, pc, delay, sound, cycles, frames, wait_key, depth = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a chip-8 snapshot")
+    data = memoryview(data)
+    cpu.I = I
+    cpu.pc = pc
+    cpu.delayTimer = delay
+    cpu.soundTimer = sound
+    cpu.cycles = cycles
+    cpu.frames = frames
+    cpu.waitKey = wait_key
+    cpu.memory[:] = data[MEMORY:REGISTERS]
+    cpu.memory_replaced()
+    cpu.register[:] = data[REGISTERS:INPUT]
+    cpu.input[:] = data[INPUT:CONTROL]
+    cpu.control[:] = data[CONTROL:FRAMEBUFFER]
+    memoryview(cpu.frameBuffer).cast('B')[:] = data[FRAMEBUFFER:RNG]
+    # Cxkk only draws getrandbits, which leaves the gaussian state alone
+    version, _, gauss = cpu.rng.getstate()
+    cpu.rng.setstate((version, tuple(array('I', data[RNG:STACK].tobytes())), gauss))
+    cpu.stack[:] = array('H', data[STACK:STACK + 2 * depth].tobytes())
+    cpu.trap = None
+    cpu.idle = False
+    cpu.idleLoop = None
+    # show the restored screen
+    cpu.publish()
+
+
+# Changed bytes, runs less than 4 zero bytes apart are merged
+CHANGES = re.compile(rb'[^\x00](?:\x00{0,3}[^\x00])*')
+RUN = struct.Struct('<HH')
+
+
+def xor(a, b):
+    size = max(len(a), len(b))
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(size, 'little')
+
+
+def encode_delta(base, data):
+    # XOR of data against base, run length encoded as
+    # length, then (gap, run length, run bytes) for every changed run
+    diff = xor(base, data)
+    parts = [struct.pack('<H', len(data))]
+    end = 0
+    for match in CHANGES.finditer(diff):
+        start = match.start()
+        parts.append(RUN.pack(start - end, match.end() - start))
+        parts.append(match.group())
+        end = match.end()
+    return b''.join(parts)
+
+
+def decode_delta(base, delta):
+    size, = struct.unpack_from('<H', delta)
+    diff = bytearray(max(size, len(base)))
+    offset = 2
+    end = 0
+    while offset < len(delta):
+        gap, length = RUN.unpack_from(delta, offset)
+        offset += RUN.size
+        end += gap
+        diff[end:end + length] = delta[offset:offset + length]
+        offset += length
+        end += length
+    return xor(base, diff)[:size]
+
+
+class Rewind:
+    # Bounded history of snapshots. Every interval-th entry is a full
+    # keyframe, the others are deltas against the keyframe before them.
+
+    def __init__(self, capacity=600, interval=60):
+        self.interval = interval
+        # (keyframe, delta or None)
+        self.entries = deque(maxlen=capacity)
+        self.keyframe = None
+        self.sinceKeyframe = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, cpu):
+        data = save(cpu)
+        if self.keyframe is None or self.sinceKeyframe >= self.interval:
+            self.keyframe = data
+            self.sinceKeyframe = 0
+            self.entries.append((data, None))
+        else:
+            self.entries.append((self.keyframe, encode_delta(self.keyframe, data)))
+        self.sinceKeyframe += 1
+
+    def snapshot(self, back=0):
+        # The snapshot pushed back entries before the last one
+        keyframe, delta = self.entries[-1 - back]
+        if delta is None:
+            return keyframe
+        return decode_delta(keyframe, delta)
+
+    def rewind(self, cpu, frames=1):
+        # Restore the state frames pushes back, dropping everything newer.
+        # Returns False when the history is not that long.
+        if frames >= len(self.entries):
+            return False
+        for _ in range(frames):
+            self.entries.pop()
+        keyframe, delta = self.entries[-1]
+        restore(cpu, self.snapshot())
+        # later pushes keep using this entry's keyframe
+        self.keyframe = keyframe
+        self.sinceKeyframe = 0
+        for entry in reversed(self.entries):
+            if entry[0] is not keyframe:
+                break
+            self.sinceKeyframe += 1
+        return True
+
+    def size(self):
+        # Bytes held, counting each keyframe once
+        keyframes = {id(k): len(k) for k, _ in self.entries}
+        return sum(keyframes.values()) + sum(len(d) for _, d in self.entries if d is not None)
@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import threading
+
+from cpu import CPU
+from snapshot import decode_delta, encode_delta
+
+# Message header: kind, frame sequence number, payload length.
+# Kind K carries a whole frame, D the delta against the last frame sent
+# to that viewer, encoded by snapshot.encode_delta.
+MESSAGE = struct.Struct('<cIH')
+FRAME_SIZE = 32 * 8
+
+
+class Session:
+    # A CPU being watched, and the viewers watching it
+
+    def __init__(self, name, cpu):
+        self.name = name
+        self.cpu = cpu
+        self.clients = set()
+        # newest frame seen
+        self.sequence = None
+        # (frame sent, newest frame) -> delta between them
+        self.deltas = {}
+
+
+class Client:
+    def __init__(self, writer):
+        self.writer = writer
+        # last frame sent, None before the first
+        self.sequence = None
+        self.frame = None
+        self.dropped = 0
+
+
+class StreamServer:
+    # Serves the frames CPUs publish to any number of viewers. Each viewer
+    # connects, sends the session name on one line and then receives a
+    # whole frame followed by deltas. Nothing is sent while the screen does
+    # not change. A viewer that cannot keep up, with more than maxBuffer
+    # bytes still unsent, skips frames and gets a delta against the last
+    # frame it was sent once it catches up.
+
+    def __init__(self, rate=60, max_buffer=16 * 1024):
+        self.interval = 1 / rate
+        self.maxBuffer = max_buffer
+        self.sessions = {}
+        self.servers = []
+
+    def add(self, name, cpu):
+        self.sessions[name] = Session(name, cpu)
+
+    def remove(self, name):
+        session = self.sessions.pop(name, None)
+        if session is not None:
+            for client in session.clients:
+                client.writer.close()
+
+    async def handle(self, reader, writer):
+        name = (await reader.readline()).decode().strip()
+        session = self.sessions.get(name)
+        if session is None:
+            writer.close()
+            return
+        client = Client(writer)
+        session.clients.add(client)
+        self.send(session, client)
+        try:
+            # viewers send nothing more, wait for them to go away
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            session.clients.discard(client)
+            writer.close()
+
+    def send(self, session, client):
+        sequence, frame = session.cpu.front
+        if client.sequence == sequence:
+            return
+        if frame == client.frame:
+            # redrawn the same, nothing to send
+            client.sequence = sequence
+            return
+        if client.writer.transport.get_write_buffer_size() > self.maxBuffer:
+            client.dropped += 1
+            return
+        if client.frame is None:
+            message = MESSAGE.pack(b'K', sequence, FRAME_SIZE) + frame
+        else:
+            # viewers on the same frame share one delta
+            key = (client.sequence, sequence)
+            delta = session.deltas.get(key)
+            if delta is None:
+                delta = session.deltas[key] = encode_delta(client.frame, frame)
+            message = MESSAGE.pack(b'D', sequence, len(delta)) + delta
+        client.writer.write(message)
+        client.sequence = sequence
+        client.frame = frame
+
+    async def pump(self):
+        # Send new frames to every viewer behind, rate times a second
+        while True:
+            for session in list(self.sessions.values()):
+                sequence = session.cpu.front[0]
+                if sequence != session.sequence:
+                    session.sequence = sequence
+                    session.deltas.clear()
+                for client in list(session.clients):
+                    if client.sequence != sequence:
+                        self.send(session, client)
+            await asyncio.sleep(self.interval)
+
+    async def serve(self, host=None, port=None, path=None):
+        # Listen on a TCP port, a Unix socket path or both, until cancelled
+        if port is not None:
+            self.servers.append(await asyncio.start_server(self.handle, host, port))
+        if path is not None:
+            self.servers.append(await asyncio.start_unix_server(self.handle, path))
+        try:
+            await self.pump()
+        finally:
+            for server in self.servers:
+                server.close()
+
+    def start(self, host=None, port=None, path=None):
+        # Serve from a background thread
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(host, port, path),), daemon=True)
+        thread.start()
+        return thread
+
+
+async def frames(reader, writer, name):
+    # Frames of a session as (sequence, rows), for viewers
+    writer.write(name.encode() + b'\n')
+    frame = None
+    while True:
+        header = await reader.readexactly(MESSAGE.size)
+        kind, sequence, length = MESSAGE.unpack(header)
+        payload = await reader.readexactly(length)
+        frame = payload if kind == b'K' else decode_delta(frame, payload)
+        yield sequence, frame
+
+
+async def view(name, host=None, port=None, path=None):
+    # Print a session's screen in the terminal as it changes
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    async for sequence, frame in frames(reader, writer, name):
+        rows = memoryview(frame).cast('Q')
+        lines = [format(row, '064b').replace('0', '.').replace('1', '#') for row in rows]
+        print("\x1b[H\x1b[2J%s  frame %d\n%s" % (name, sequence, "\n".join(lines)), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream chip-8 screens to remote viewers")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--unix', metavar='PATH', help="Unix socket instead of TCP")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="run ROMs in real time and serve their screens")
+    serve.add_argument('roms', nargs='+')
+    watch = commands.add_parser('view', help="show a served screen")
+    watch.add_argument('name', help="the ROM's file name without extension")
+    args = parser.parse_args()
+    if args.port is None and args.unix is None:
+        args.port = 8064
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == 'view':
+        asyncio.run(view(args.name, args.host, args.port, args.unix))
+        return
+    server = StreamServer()
+    for rom in args.roms:
+        cpu = CPU()
+        cpu.load_rom(rom)
+        cpu.start()
+        server.add(os.path.splitext(os.path.basename(rom))[0], cpu)
+    asyncio.run(server.serve(args.host, args.port, args.unix))
+
+
+if __name__ == "__main__":
+    main()
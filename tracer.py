@@ -0,0 +1,69 @@
+from array import array
+
+from cpu import CPU
+
+
+class Tracer:
+    # Records (pc, opcode, registers) for the last size instructions.
+    # While enabled the tracer stands in for the CPU's decode table and
+    # decodes through whatever was in place before it, so a CPU that is not
+    # traced runs exactly the code it would without it.
+
+    def __init__(self, cpu, size=1024):
+        self.cpu = cpu
+        self.size = size
+        self.pcs = array('H', [0]) * size
+        self.ops = array('H', [0]) * size
+        self.registers = bytearray(16 * size)
+        # instructions recorded since the tracer was created
+        self.count = 0
+        # decoding before the tracer's
+        self.table = CPU.table
+
+    def enable(self):
+        # decode through whatever was in place, a debugger or profiler
+        if not self.enabled:
+            self.table = self.cpu.decoded
+            self.cpu.decoded = self
+
+    def disable(self):
+        if self.enabled:
+            self.cpu.decoded = self.table
+
+    @property
+    def enabled(self):
+        return self.cpu.decoded is self
+
+    def clear(self):
+        self.count = 0
+
+    def __getitem__(self, op):
+        cpu = self.cpu
+        i = self.count % self.size
+        # pc has already moved past the instruction
+        self.pcs[i] = (cpu.pc - 2) & 0xfff
+        self.ops[i] = op
+        self.registers[16 * i:16 * i + 16] = cpu.register
+        self.count += 1
+        return self.table[op]
+
+    def entries(self):
+        # Recorded (pc, opcode, registers) from oldest to newest
+        first = max(self.count - self.size, 0)
+        for n in range(first, self.count):
+            i = n % self.size
+            yield self.pcs[i], self.ops[i], bytes(self.registers[16 * i:16 * i + 16])
+
+    def dump(self, decode=False):
+        lines = []
+        for pc, op, registers in self.entries():
+            line = "%03X  %04X  %s" % (pc, op, registers.hex(' '))
+            if decode:
+                line += "  " + describe(op)
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def describe(op):
+    handler, operands = CPU.table[op]
+    return "%s %s" % (handler.__name__.lstrip('_'), " ".join("%X" % o for o in operands))
@@ -0,0 +1,302 @@
+import logging
+import time
+from collections import OrderedDict
+
+import disasm
+from cpu import CPU, BLANK, POLL_LOOP_SIZE
+
+# Most instructions compiled into one block
+MAX_BLOCK = 64
+
+# Block source -> compiled code, shared by every translator, so a ROM is
+# only compiled once however often it is reloaded or run. The least
+# recently used blocks are dropped past COMPILED_MAX.
+COMPILED_MAX = 4096
+compiled = OrderedDict()
+
+# Straight-line handlers inlined into the block body
+BODY = {
+    '_00e0': ['cpu.frameBuffer[:] = BLANK',
+              'cpu.control[0] = True'],
+    '_6000': ['r[{x}] = {kk}'],
+    '_7000': ['r[{x}] = (r[{x}] + {kk}) & 0xff'],
+    '_8FF0': ['r[{x}] = r[{y}]'],
+    '_8FF1': ['r[{x}] |= r[{y}]'],
+    '_8FF2': ['r[{x}] &= r[{y}]'],
+    '_8FF3': ['r[{x}] ^= r[{y}]'],
+    '_8FF4': ['r[0xf] = 1 if r[{x}] + r[{y}] > 0xff else 0',
+              'r[{x}] = (r[{x}] + r[{y}]) & 0xff'],
+    '_8FF5': ['r[0xf] = 0 if r[{y}] > r[{x}] else 1',
+              'r[{x}] = (r[{x}] - r[{y}]) & 0xff'],
+    '_8FF6': ['r[0xf] = r[{x}] & 0x0001',
+              'r[{x}] = r[{x}] >> 1'],
+    '_8FF7': ['r[0xf] = 0 if r[{x}] > r[{y}] else 1',
+              'r[{x}] = (r[{y}] - r[{x}]) & 0xff'],
+    '_8FFE': ['r[0xf] = (r[{x}] & 0x00f0) >> 7',
+              'r[{x}] = (r[{x}] << 1) & 0xff'],
+    '_A000': ['cpu.I = {nnn}'],
+    '_C000': ['r[{x}] = cpu.rng.getrandbits(8) & {kk}'],
+    '_F007': ['r[{x}] = cpu.delayTimer'],
+    '_F015': ['cpu.delayTimer = r[{x}]'],
+    '_F018': ['cpu.soundTimer = r[{x}]'],
+    '_F01E': ['i = cpu.I + r[{x}]',
+              'if i > 0xfff:',
+              '    r[0xf] = 1',
+              '    i &= 0xfff',
+              'else:',
+              '    r[0xf] = 0',
+              'cpu.I = i'],
+    '_F029': ['cpu.I = (5 * r[{x}]) & 0xfff'],
+}
+
+# Handlers called from the middle of a block, they leave pc alone
+CALLS = ('_D000', '_F065')
+
+# Skips, compiled as an exit from the block when the condition holds
+SKIPS = {
+    '_3000': 'r[{x}] == {kk}',
+    '_4000': 'r[{x}] != {kk}',
+    '_5000': 'r[{x}] == r[{y}]',
+    '_E0A1': 'cpu.input[{x}] == 0',
+}
+
+# Jumps and calls are followed into the same block unless they go back to
+# an address already in it. Everything else (memory stores, key wait,
+# traps) ends the block with a call to the CPU handler itself, as do short
+# backward jumps so the CPU can spot idle loops
+
+
+class Translator:
+    # Runs a CPU from blocks of ROM code compiled into Python functions.
+    # A block is called with the most instructions it may execute, and
+    # returns early at that limit. Blocks never run past a frame boundary
+    # or the cycle budget, so the timers tick and the screen is published
+    # after exactly the same instructions as with CPU.run.
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # start address -> (block, most instructions, bytes written)
+        self.blocks = {}
+        # start address -> addresses the block was compiled from
+        self.extent = {}
+        # address -> start addresses of the blocks covering it
+        self.owners = [None] * 4096
+        # a new ROM or a restored snapshot makes every block stale
+        cpu.memoryListeners.append(self.flush)
+
+    def flush(self):
+        self.blocks.clear()
+        self.extent.clear()
+        self.owners[:] = [None] * 4096
+
+    def invalidate(self, start, end):
+        owners = self.owners
+        for addr in range(start, end):
+            addr &= 0xfff
+            if owners[addr]:
+                for block in list(owners[addr]):
+                    self.discard(block)
+
+    def discard(self, start):
+        del self.blocks[start]
+        for addr in self.extent.pop(start):
+            self.owners[addr].remove(start)
+
+    def load(self, rom):
+        # Load a ROM and translate the blocks found by its cached
+        # control-flow analysis, so it starts warm
+        self.cpu.load_rom(rom)
+        self.warm(disasm.load(rom).leaders())
+
+    def warm(self, starts):
+        # Translate blocks ahead of time, e.g. from disasm.Analysis.leaders()
+        for start in starts:
+            if start not in self.blocks and start + 1 < 4096:
+                self.translate(start)
+
+    def translate(self, start):
+        memory = self.cpu.memory
+        lines = ['def block(cpu, limit):', '    r = cpu.register', '    s = 0']
+        env = {'BLANK': BLANK, 'logging': logging}
+        pc = start
+        count = 0
+        writes = 0
+        op = 0
+        covered = []
+        while True:
+            if count:
+                if count == MAX_BLOCK or pc + 1 >= 4096 or pc in covered:
+                    lines.append('    cpu.pc = %d' % pc)
+                    break
+                # stop at the limit, before the next instruction
+                lines.extend(['    if limit == %d:' % count,
+                              '        cpu.pc = %d' % pc,
+                              '        return %d - s' % count])
+            op = (memory[pc] << 8) | memory[pc + 1]
+            handler, operands = CPU.table[op]
+            name = handler.__name__
+            covered.extend((pc, pc + 1))
+            pc += 2
+            count += 1
+            fields = self.fields(op, pc)
+            if name in BODY:
+                lines.extend('    ' + line.format(**fields) for line in BODY[name])
+            elif name in CALLS:
+                env[name] = handler
+                lines.extend(self.guard(['%s(cpu, *%r)' % (name, operands)], op, '    '))
+            elif name in SKIPS:
+                condition = SKIPS[name].format(**fields)
+                following = self.inline(pc, covered)
+                if following is None:
+                    lines.extend(['    if %s:' % condition,
+                                  '        cpu.pc = %d' % (pc + 2),
+                                  '        return %d - s' % count])
+                    continue
+                # skip over a straight-line instruction within the block,
+                # the limit stands one higher for every instruction skipped
+                covered.extend((pc, pc + 1))
+                lines.extend(['    if %s:' % condition,
+                              '        if limit == %d:' % count,
+                              '            cpu.pc = %d' % (pc + 2),
+                              '            return %d - s' % count,
+                              '        limit += 1',
+                              '        s += 1',
+                              '    else:',
+                              '        if limit == %d:' % count,
+                              '            cpu.pc = %d' % pc,
+                              '            return %d - s' % count])
+                name, operands, op = following
+                pc += 2
+                count += 1
+                fields = self.fields(op, pc)
+                if name in BODY:
+                    lines.extend('        ' + line.format(**fields) for line in BODY[name])
+                else:
+                    env[name] = CPU.table[op][0]
+                    lines.extend(self.guard(['%s(cpu, *%r)' % (name, operands)], op, '        '))
+            elif name == '_00ee':
+                lines.append('    cpu.pc = %d' % pc)
+                lines.extend(self.guard(['cpu.pc = cpu.stack.pop()'], op, '    '))
+                break
+            elif name in ('_1000', '_2000') and not (name == '_1000' and 0 < pc - fields['nnn'] <= POLL_LOOP_SIZE + 2):
+                lines.append('    cpu.idleLoop = None' if name == '_1000' else '    cpu.stack.append(%d)' % pc)
+                pc = fields['nnn']
+            else:
+                env[name] = handler
+                lines.append('    cpu.pc = %d' % pc)
+                lines.extend(self.guard(['%s(cpu, *%r)' % (name, operands)], op, '    '))
+                if name == '_F033':
+                    writes = 3
+                elif name == '_F055':
+                    writes = operands[0] + 1
+                break
+        lines.append('    return %d - s' % count)
+
+        source = '\n'.join(lines)
+        code = compiled.get(source)
+        if code is None:
+            code = compiled[source] = compile(source, '<block %X>' % start, 'exec')
+            if len(compiled) > COMPILED_MAX:
+                compiled.popitem(last=False)
+        else:
+            compiled.move_to_end(source)
+        exec(code, env)
+        block = (env['block'], count, writes)
+        self.blocks[start] = block
+        self.extent[start] = covered
+        for addr in covered:
+            if self.owners[addr] is None:
+                self.owners[addr] = []
+            self.owners[addr].append(start)
+        return block
+
+    def guard(self, lines, op, indent):
+        # lines that may raise, logged and carried on from as CPU.cycle does
+        return ([indent + 'try:'] + [indent + '    ' + line for line in lines] +
+                [indent + 'except:', indent + '    logging.error("Instruction error: %%X", %d)' % op])
+
+    def inline(self, pc, covered):
+        # (name, operands, opcode) of the instruction at pc when it can be
+        # compiled into the middle of a block, None otherwise
+        if pc + 1 >= 4096 or pc in covered:
+            return None
+        op = (self.cpu.memory[pc] << 8) | self.cpu.memory[pc + 1]
+        handler, operands = CPU.table[op]
+        if handler.__name__ not in BODY and handler.__name__ not in CALLS:
+            return None
+        return handler.__name__, operands, op
+
+    def fields(self, op, pc):
+        return {
+            'x': (op & 0x0f00) >> 8,
+            'y': (op & 0x00f0) >> 4,
+            'kk': op & 0x00ff,
+            'nnn': op & 0x0fff,
+            'next': pc,
+        }
+
+    def fallback(self, run, *args):
+        # Run on the CPU's own path, dropping the blocks it overwrote
+        memory = self.cpu.memory
+        before = bytes(memory)
+        result = run(*args)
+        if memory != before:
+            changed = [addr for addr in range(len(memory)) if memory[addr] != before[addr]]
+            self.invalidate(changed[0], changed[-1] + 1)
+        return result
+
+    def run(self, cycles=None, until_pc=None, max_time=None):
+        # CPU.run from compiled blocks, with the same arguments and results
+        cpu = self.cpu
+        if cpu.decoded is not CPU.table or until_pc is not None:
+            # instrumented decode table or a stop inside blocks, stay on
+            # the per-opcode path
+            return self.fallback(cpu.run, cycles, until_pc, max_time)
+        if cycles is None:
+            cycles = float('inf')
+        if max_time is not None:
+            deadline = time.perf_counter() + max_time
+        blocks = self.blocks
+        owners = self.owners
+        ipf = cpu.ipf
+        executed = 0
+        cpu.running = True
+        while cpu.running and executed < cycles:
+            # the rest of the current frame
+            n = min(ipf - cpu.cycles % ipf, cycles - executed)
+            done = 0
+            while done < n and cpu.running:
+                pc = cpu.pc
+                block = blocks.get(pc)
+                if block is None:
+                    if pc + 1 >= 4096:
+                        self.fallback(cpu.cycle)
+                        done += 1
+                        continue
+                    block = self.translate(pc)
+                function, count, writes = block
+                done += function(cpu, n - done)
+                if cpu.idle:
+                    cpu.idle = False
+                    if cpu.skipIdle:
+                        # nothing changes before the next tick, skip the rest of the frame
+                        done = n
+                # self-modifying code
+                if writes:
+                    for addr in range(cpu.I, cpu.I + writes):
+                        if owners[addr & 0xfff]:
+                            self.invalidate(cpu.I, cpu.I + writes)
+                            break
+            executed += done
+            cpu.cycles += done
+            if done and not cpu.cycles % ipf:
+                cpu.tick_timers()
+            if done < n or cpu.blocked():
+                break
+            if max_time is not None and time.perf_counter() >= deadline:
+                break
+        return executed
+
+    def run_frame(self):
+        # Run to the end of the current frame
+        return self.run(self.cpu.ipf - self.cpu.cycles % self.cpu.ipf)